@@ -1,9 +1,39 @@
-from flask import Flask, request, jsonify, render_template, send_from_directory
+from flask import Flask, Response, g, request, jsonify, render_template, send_from_directory
+from flask.json.provider import DefaultJSONProvider
 from werkzeug.utils import secure_filename
-from pymongo import MongoClient
-import pandas as pd
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import MongoClient, DeleteOne, ReplaceOne, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.worksheet.cell_range import CellRange
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from copy import copy
+import brotli
+import orjson
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess
+import csv
+import datetime as dt
+import functools
+import gzip
+import hashlib
+import multiprocessing
+import shutil
+import tempfile
+import threading
+import time
+import uuid
 import os
 import io
+import json
+import logging
+import math
+import re
+import zipfile
 
 app = Flask(__name__, static_folder="static", template_folder="templates")
 
@@ -12,19 +42,1858 @@ MONGO_URI = os.environ.get("MONGO_URI", "mongodb://mongo:27017/")
 DB_NAME = os.environ.get("DB_NAME", "mydb")
 COLLECTION_NAME = os.environ.get("COLLECTION_NAME", "items")
 
-client = MongoClient(MONGO_URI)
+# 結構化日誌：每行一個 JSON 物件，等級由 LOG_LEVEL 控制（DEBUG 會記錄每個請求與撿貨查詢）
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# 超過此毫秒數的請求 / Mongo 指令以 WARNING 記錄
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", "1000"))
+SLOW_MONGO_MS = float(os.environ.get("SLOW_MONGO_MS", "200"))
+_LOG_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonLogFormatter(logging.Formatter):
+    """將 LogRecord 與 extra 欄位輸出為單行 JSON。"""
+
+    def format(self, record):
+        entry = {
+            "ts": dt.datetime.fromtimestamp(record.created, dt.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+            "pid": record.process,
+        }
+        entry.update({k: v for k, v in vars(record).items() if k not in _LOG_RECORD_FIELDS})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(JsonLogFormatter())
+logger = logging.getLogger("mongo_app")
+logger.addHandler(_log_handler)
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+
+# Prometheus 指標；gunicorn 多 worker 時設定 PROMETHEUS_MULTIPROC_DIR，各 process 寫入共享目錄後由 /metrics 彙總
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP requests", ["method", "route", "status"])
+HTTP_LATENCY = Histogram(
+    "http_request_duration_seconds", "HTTP request latency", ["method", "route"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+IMPORT_ROWS = Counter("import_rows_total", "Rows processed by Excel uploads", ["collection", "outcome"])
+MONGO_COMMANDS = Counter("mongo_commands_total", "MongoDB commands", ["command", "collection", "status"])
+MONGO_LATENCY = Histogram(
+    "mongo_command_duration_seconds", "MongoDB command latency", ["command", "collection"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 10),
+)
+
+
+class MongoRequestStats:
+    """單一請求的 Mongo 指令次數與耗時；請求的 fan-out 查詢在其他 thread 執行，故以 lock 累加。"""
+
+    def __init__(self):
+        self.commands = 0
+        self.ms = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, ms):
+        with self._lock:
+            self.commands += 1
+            self.ms += ms
+
+
+# 目前 thread 所屬請求的 MongoRequestStats（請求 thread 與 fan_out 的工作 thread 都會設定）
+_request_mongo_stats = threading.local()
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """
+    pymongo 指令監聽：依指令與 collection 累計次數與耗時，
+    並把次數 / 耗時加總到目前請求的 MongoRequestStats，用於找出 N+1 查詢。
+    """
+
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            target = event.command.get("collection")
+        self._collections[(event.connection_id, event.request_id)] = target if isinstance(target, str) else ""
+
+    def _finished(self, event, status):
+        coll = self._collections.pop((event.connection_id, event.request_id), "")
+        seconds = event.duration_micros / 1e6
+        MONGO_COMMANDS.labels(event.command_name, coll, status).inc()
+        MONGO_LATENCY.labels(event.command_name, coll).observe(seconds)
+        stats = getattr(_request_mongo_stats, "value", None)
+        if stats is not None:
+            stats.add(seconds * 1000)
+        if seconds * 1000 >= SLOW_MONGO_MS:
+            logger.warning("slow_mongo_command", extra={
+                "command": event.command_name, "collection": coll,
+                "duration_ms": round(seconds * 1000, 1), "status": status,
+            })
+
+    def succeeded(self, event):
+        self._finished(event, "ok")
+
+    def failed(self, event):
+        self._finished(event, "error")
+
+
+# 連線池：每個 gunicorn worker 一個共用 MongoClient；並行讀取最多同時使用 READ_POOL_WORKERS 條連線
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", "32"))
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", "4"))
+MONGO_MAX_IDLE_MS = int(os.environ.get("MONGO_MAX_IDLE_MS", "300000"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", "10000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", "10000"))
+
+client = MongoClient(
+    MONGO_URI,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    maxIdleTimeMS=MONGO_MAX_IDLE_MS,
+    waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    appname="mongo_app",
+    event_listeners=[MongoCommandMetrics()],
+)
 db = client[DB_NAME]
 collection = db[COLLECTION_NAME]
 
-# 新增採購與出貨表、庫存與採購需求表的匯入 API
-PURCHASE_SHIPPING_COLLECTION_NAME = os.environ.get("PURCHASE_SHIPPING_COLLECTION_NAME", "purchase_shipping")
-INVENTORY_NEED_COLLECTION_NAME = os.environ.get("INVENTORY_NEED_COLLECTION_NAME", "inventory_need")
-purchase_shipping_collection = db[PURCHASE_SHIPPING_COLLECTION_NAME]
-inventory_need_collection = db[INVENTORY_NEED_COLLECTION_NAME]
+# 新增採購與出貨表、庫存與採購需求表的匯入 API
+PURCHASE_SHIPPING_COLLECTION_NAME = os.environ.get("PURCHASE_SHIPPING_COLLECTION_NAME", "purchase_shipping")
+INVENTORY_NEED_COLLECTION_NAME = os.environ.get("INVENTORY_NEED_COLLECTION_NAME", "inventory_need")
+purchase_shipping_collection = db[PURCHASE_SHIPPING_COLLECTION_NAME]
+inventory_need_collection = db[INVENTORY_NEED_COLLECTION_NAME]
+
+# 新增客戶需求表匯入 API
+CUSTOMER_NEED_COLLECTION_NAME = os.environ.get("CUSTOMER_NEED_COLLECTION_NAME", "customer_need")
+customer_need_collection = db[CUSTOMER_NEED_COLLECTION_NAME]
+
+PRODUCTS_COLLECTION_NAME = os.environ.get("PRODUCTS_COLLECTION_NAME", "products")
+products_collection = db[PRODUCTS_COLLECTION_NAME]
+STOCK_RECORDS_COLLECTION_NAME = os.environ.get("STOCK_RECORDS_COLLECTION_NAME", "stock_records")
+stock_records_collection = db[STOCK_RECORDS_COLLECTION_NAME]
+
+# 正規化料號欄位：Excel 匯入的料號可能是 int / float / str，統一存成字串並建立索引
+PARTNO_KEY = "_partno"
+PARTNO_COLLECTIONS = [
+    products_collection,
+    purchase_shipping_collection,
+    inventory_need_collection,
+    customer_need_collection,
+    stock_records_collection,
+]
+
+
+def normalize_partno(value):
+    """
+    將料號轉為統一的字串鍵：251140、251140.0、"251140"、"251140.0" 都得到 "251140"。
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, float):
+        if value != value:
+            return None
+        if value.is_integer():
+            return str(int(value))
+        return repr(value)
+    if isinstance(value, int):
+        return str(value)
+    key = str(value).strip()
+    if re.fullmatch(r"\d+\.0+", key):
+        key = key.split(".")[0]
+    return key or None
+
+
+# 撿貨搜尋用的日期欄位，匯入時轉為 BSON 日期，原始值存於 _raw
+DATE_FIELDS = ["MIC需求起日", "MIC需求訖日"]
+RAW_FIELD = "_raw"
+PICK_COLLECTIONS = [
+    purchase_shipping_collection,
+    inventory_need_collection,
+    customer_need_collection,
+]
+
+_indexes_ready = False
+_indexes_lock = threading.Lock()
+
+
+def ensure_indexes():
+    """建立查詢所需的索引（create_index 為冪等操作）。"""
+    global _indexes_ready
+    if _indexes_ready:
+        return
+    with _indexes_lock:
+        if _indexes_ready:
+            return
+        for coll in PARTNO_COLLECTIONS:
+            coll.create_index(PARTNO_KEY)
+        for coll in PICK_COLLECTIONS:
+            coll.create_index([(field, 1) for field in DATE_FIELDS])
+            coll.create_index("PO單號")
+        for coll in [collection] + PICK_COLLECTIONS:
+            coll.create_index(ROW_KEY)
+        catalog_collection.create_index("料號系列")
+        import_jobs_collection.create_index("finished_at", expireAfterSeconds=IMPORT_JOB_TTL)
+        stock_records_collection.create_index(
+            IDEMPOTENCY_KEY, unique=True, partialFilterExpression={IDEMPOTENCY_KEY: {"$exists": True}}
+        )
+        _indexes_ready = True
+
+
+# 料號資訊查詢順序：products 優先，其次為三個匯入資料庫
+PRODUCT_INFO_COLLECTIONS = [
+    products_collection,
+    purchase_shipping_collection,
+    inventory_need_collection,
+    customer_need_collection,
+]
+
+
+# 多資料庫讀取的並行 fan-out：每個 worker 一個有上限的共用 thread pool
+READ_POOL_WORKERS = int(os.environ.get("READ_POOL_WORKERS", "8"))
+READ_POOL_THREAD_PREFIX = "mongo-read"
+
+_read_pool = None
+_read_pool_lock = threading.Lock()
+
+
+def get_read_pool():
+    """延遲建立讀取用的 thread pool（gunicorn fork 後才在各 worker 建立）。"""
+    global _read_pool
+    with _read_pool_lock:
+        if _read_pool is None:
+            _read_pool = ThreadPoolExecutor(max_workers=READ_POOL_WORKERS, thread_name_prefix=READ_POOL_THREAD_PREFIX)
+        return _read_pool
+
+
+def submit_read(fn, *args):
+    """
+    將一個讀取工作排入 read pool，回傳 Future；工作 thread 的 Mongo 指令仍計入目前請求。
+    已在 read pool 內時直接執行（避免有上限的 pool 因巢狀等待而卡住）。
+    """
+    stats = getattr(_request_mongo_stats, "value", None)
+
+    def run():
+        _request_mongo_stats.value = stats
+        try:
+            return fn(*args)
+        finally:
+            _request_mongo_stats.value = None
+
+    if threading.current_thread().name.startswith(READ_POOL_THREAD_PREFIX):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+    return get_read_pool().submit(run)
+
+
+def fan_out(fn, items):
+    """對 items 的每一項並行呼叫 fn(item)，依 items 的順序回傳結果，讓合併順序固定。"""
+    items = list(items)
+    if len(items) <= 1:
+        return [fn(item) for item in items]
+    return [future.result() for future in [submit_read(fn, item) for item in items]]
+
+
+def lookup_product_fields(keys, fields, collections=None):
+    """
+    以 _partno 批次查詢料號資訊，回傳 {料號鍵: {欄位: 值}}。
+    各 collection 並行對整批料號做一次 $in aggregation（每個料號取第一筆），
+    再依 collections 順序合併，先找到的值優先。
+    """
+    found = {key: {} for key in keys if key}
+    if not found:
+        return found
+    pipeline = [
+        {"$match": {PARTNO_KEY: {"$in": list(found)}}},
+        {"$group": {"_id": f"${PARTNO_KEY}", **{f: {"$first": f"${f}"} for f in fields}}},
+    ]
+    results = fan_out(lambda coll: list(coll.aggregate(pipeline)), collections or PRODUCT_INFO_COLLECTIONS)
+    for docs in results:
+        for doc in docs:
+            info = found[doc["_id"]]
+            for f in fields:
+                val = doc.get(f)
+                if val is not None and f not in info:
+                    info[f] = val
+    return found
+
+
+# 料號目錄：料號系列 → 料號 → 產品資訊 下拉選單的物化資料
+CATALOG_COLLECTION_NAME = os.environ.get("CATALOG_COLLECTION_NAME", "product_catalog")
+catalog_collection = db[CATALOG_COLLECTION_NAME]
+CATALOG_SOURCES = PRODUCT_INFO_COLLECTIONS + [stock_records_collection]
+CATALOG_FIELDS = ["產品中文名稱", "單價", "庫存"]
+CATALOG_BATCH_SIZE = 1000
+
+
+def refresh_catalog(keys):
+    """
+    重新計算指定料號的目錄資料並寫回 catalog_collection。
+    料號系列取所有來源的聯集，產品資訊依 CATALOG_SOURCES 順序取第一個非空值；
+    庫存以庫存帳（stock_balances）為準，沒有庫存異動的料號才使用匯入資料的值。
+    已不存在於任何來源的料號會從目錄移除。回傳處理的料號數。
+    """
+    keys = sorted({key for key in keys if key})
+    for i in range(0, len(keys), CATALOG_BATCH_SIZE):
+        batch = keys[i:i + CATALOG_BATCH_SIZE]
+        entries = {}
+        pipeline = [
+            {"$match": {PARTNO_KEY: {"$in": batch}}},
+            {"$group": {
+                "_id": f"${PARTNO_KEY}",
+                "料號系列": {"$addToSet": "$料號系列"},
+                **{f: {"$first": f"${f}"} for f in CATALOG_FIELDS},
+            }},
+        ]
+        # 各來源並行查詢，依 CATALOG_SOURCES 順序合併
+        for docs in fan_out(lambda coll: list(coll.aggregate(pipeline)), CATALOG_SOURCES):
+            for doc in docs:
+                entry = entries.setdefault(doc["_id"], {"_id": doc["_id"], "料號": doc["_id"], "料號系列": set()})
+                for series in doc["料號系列"]:
+                    if series is not None and str(series).strip():
+                        entry["料號系列"].add(str(series).strip())
+                for f in CATALOG_FIELDS:
+                    val = doc.get(f)
+                    if val is not None and entry.get(f) is None:
+                        entry[f] = val
+        for key, quantity in stock_on_hand(entries).items():
+            entries[key]["庫存"] = quantity
+        ops = []
+        for key in batch:
+            entry = entries.get(key)
+            if entry is None:
+                ops.append(DeleteOne({"_id": key}))
+            else:
+                entry["料號系列"] = sorted(entry["料號系列"])
+                ops.append(ReplaceOne({"_id": key}, entry, upsert=True))
+        catalog_collection.bulk_write(ops, ordered=False)
+    return len(keys)
+
+
+# 讀取 API 快取：有大小上限與 TTL，上傳、清除、入庫時失效。
+# 資料版本號存在 Mongo，讓其他 gunicorn worker 的快取也能在 CACHE_VERSION_CHECK 秒內失效。
+CACHE_MAXSIZE = int(os.environ.get("CACHE_MAXSIZE", "256"))
+CACHE_TTL = float(os.environ.get("CACHE_TTL", "300"))
+CACHE_VERSION_CHECK = float(os.environ.get("CACHE_VERSION_CHECK", "2"))
+META_COLLECTION_NAME = os.environ.get("META_COLLECTION_NAME", "app_meta")
+meta_collection = db[META_COLLECTION_NAME]
+
+
+class ResponseCache:
+    """以 OrderedDict 實作的 LRU + TTL 快取，並記錄命中統計。"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                self._data.pop(key, None)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+                "not_modified": self.not_modified,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+            }
+
+
+response_cache = ResponseCache(CACHE_MAXSIZE, CACHE_TTL)
+_data_version = {"value": None, "checked": 0.0}
+
+
+def current_data_version():
+    """取得資料版本號，每 CACHE_VERSION_CHECK 秒最多向 Mongo 查詢一次。"""
+    now = time.monotonic()
+    if _data_version["value"] is None or now - _data_version["checked"] >= CACHE_VERSION_CHECK:
+        doc = meta_collection.find_one({"_id": "data_version"})
+        _data_version["value"] = doc["value"] if doc else 0
+        _data_version["checked"] = now
+    return _data_version["value"]
+
+
+def invalidate_cache():
+    """資料異動後呼叫：遞增共用版本號並清除本 worker 的快取。"""
+    doc = meta_collection.find_one_and_update(
+        {"_id": "data_version"}, {"$inc": {"value": 1}}, upsert=True, return_document=ReturnDocument.AFTER
+    )
+    _data_version["value"] = doc["value"]
+    _data_version["checked"] = time.monotonic()
+    response_cache.clear()
+
+
+def cached_response(view):
+    """
+    快取 GET API 的 200 回應（依路徑與查詢參數），
+    並附上 ETag，瀏覽器帶 If-None-Match 且內容未變時回傳 304。
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = (current_data_version(), request.path, tuple(sorted(request.args.items(multi=True))))
+        entry = response_cache.get(key)
+        if entry is None:
+            resp = app.make_response(view(*args, **kwargs))
+            if resp.status_code != 200:
+                return resp
+            body = resp.get_data()
+            entry = (body, resp.mimetype, hashlib.sha1(body).hexdigest())
+            response_cache.set(key, entry)
+        body, mimetype, etag = entry
+        resp = app.response_class(body, mimetype=mimetype)
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = "no-cache"
+        resp = resp.make_conditional(request)
+        if resp.status_code == 304:
+            response_cache.not_modified += 1
+        return resp
+    return wrapper
+
+
+@app.before_request
+def _start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.mongo_stats = _request_mongo_stats.value = MongoRequestStats()
+
+
+@app.after_request
+def _record_request_metrics(response):
+    started = g.pop("request_started", None)
+    _request_mongo_stats.value = None
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    route = request.url_rule.rule if request.url_rule else "<unmatched>"
+    HTTP_REQUESTS.labels(request.method, route, str(response.status_code)).inc()
+    HTTP_LATENCY.labels(request.method, route).observe(elapsed)
+    fields = {
+        "method": request.method, "route": route, "status": response.status_code,
+        "duration_ms": round(elapsed * 1000, 1),
+        "mongo_commands": g.mongo_stats.commands, "mongo_ms": round(g.mongo_stats.ms, 1),
+    }
+    if fields["duration_ms"] >= SLOW_REQUEST_MS:
+        logger.warning("slow_request", extra={**fields, "query": request.query_string.decode("utf-8", "replace")})
+    else:
+        logger.debug("request", extra=fields)
+    return response
+
+
+# ensure_indexes 失敗（例如既有資料違反 unique index）後的重試間隔秒數，避免每個請求都重跑所有 create_index
+INDEX_RETRY_SECONDS = float(os.environ.get("INDEX_RETRY_SECONDS", "60"))
+_indexes_retry_at = 0.0
+
+
+@app.before_request
+def _ensure_indexes_once():
+    global _indexes_retry_at
+    if _indexes_ready or time.monotonic() < _indexes_retry_at:
+        return
+    try:
+        ensure_indexes()
+    except Exception as e:
+        _indexes_retry_at = time.monotonic() + INDEX_RETRY_SECONDS
+        logger.warning("ensure_indexes_failed", extra={"error": str(e), "retry_in_s": INDEX_RETRY_SECONDS}, exc_info=True)
+
+
+# Excel 匯入每批寫入筆數
+IMPORT_CHUNK_SIZE = int(os.environ.get("IMPORT_CHUNK_SIZE", "5000"))
+# 匯入統計中最多保留的錯誤訊息數
+MAX_IMPORT_ERRORS = 20
+
+
+# Excel 匯入共用流程
+def iter_excel_rows(stream, sheet=None):
+    """
+    以 openpyxl read-only 模式逐列讀取 sheet（名稱；預設第一個 sheet），產生 (欄位名稱, 值 tuple)。
+    第一列視為欄位名稱，規則與 pd.read_excel 相同（空白欄名為 "Unnamed: N"，重複欄名加 ".1"）。
+    """
+    wb = load_workbook(stream, read_only=True, data_only=True)
+    try:
+        ws = wb[sheet] if sheet is not None else wb.worksheets[0]
+        rows = ws.iter_rows(values_only=True)
+        header = _excel_header(next(rows, ()))
+        for row in rows:
+            if all(v is None for v in row):
+                continue
+            if len(row) > len(header):
+                header = _excel_header(header + [None] * (len(row) - len(header)))
+            yield header, row
+    finally:
+        wb.close()
+
+
+def _excel_header(cells):
+    header = []
+    seen = {}
+    cells = list(cells)
+    while cells and cells[-1] is None:
+        cells.pop()
+    for idx, name in enumerate(cells):
+        name = f"Unnamed: {idx}" if name is None else str(name)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        header.append(name)
+    return header
+
+
+def normalize_value(value):
+    """將 openpyxl 讀出的儲存格值轉為可寫入 MongoDB 的型別。"""
+    if isinstance(value, float) and value != value:
+        return None
+    if isinstance(value, dt.time):
+        return value.isoformat()
+    if isinstance(value, dt.date) and not isinstance(value, dt.datetime):
+        return dt.datetime(value.year, value.month, value.day)
+    return value
+
+
+def parse_date(value):
+    """
+    將日期欄位值解析為 datetime，支援 datetime、20250604 形式的整數，
+    以及 "2025-06-04"、"2025/06/04"、"2025-06-04T00:00:00" 等字串；無法解析時回傳 None。
+    """
+    if isinstance(value, dt.datetime):
+        return value
+    if isinstance(value, dt.date):
+        return dt.datetime(value.year, value.month, value.day)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if value != value or not float(value).is_integer():
+            return None
+        value = int(value)
+        if not 10000000 <= value <= 99999999:
+            return None
+        try:
+            return dt.datetime(value // 10000, value // 100 % 100, value % 100)
+        except ValueError:
+            return None
+    if not isinstance(value, str):
+        return None
+    value = value.strip()
+    for fmt in ["%Y-%m-%d", "%Y/%m/%d", "%Y-%m-%dT%H:%M:%S", "%Y/%m/%dT%H:%M:%S", "%Y%m%d"]:
+        try:
+            return dt.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    try:
+        return dt.datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+# 匯入欄位型別（宣告式 schema）：每批資料逐欄依型別轉換，NaN 在寫入前統一轉為 None
+#   date：轉為 BSON 日期（規則同 parse_date），原始值不是日期時保留於 _raw；無法解析時保留原值
+#   number：轉為數值，整數值存成 int；無法轉換的原始值保留，空白字串為 None
+#   partno：保留原值（另外產生 _partno 鍵）
+#   text：去除前後空白的字串，數值轉為字串（整數值不帶 .0），空白字串為 None
+BASE_COLUMN_SCHEMA = {
+    "MIC需求起日": "date",
+    "MIC需求訖日": "date",
+    "料號": "partno",
+    "版本": "text",
+    "數量": "number",
+    "單價": "number",
+    "庫存": "number",
+    "PO單號": "text",
+    "產品中文名稱": "text",
+}
+COLUMN_SCHEMAS = {
+    PURCHASE_SHIPPING_COLLECTION_NAME: {
+        **BASE_COLUMN_SCHEMA,
+        "訂購日期": "date",
+        "預計交期": "date",
+        "單 價": "number",
+        "小計": "number",
+        "系列": "text",
+        "採購單號": "text",
+        "出貨單據編號": "text",
+    },
+    INVENTORY_NEED_COLLECTION_NAME: {
+        **BASE_COLUMN_SCHEMA,
+        "剩餘採購數量": "number",
+        "系列": "text",
+    },
+    CUSTOMER_NEED_COLLECTION_NAME: BASE_COLUMN_SCHEMA,
+}
+
+
+def column_schema(coll):
+    return COLUMN_SCHEMAS.get(coll.name, BASE_COLUMN_SCHEMA)
+
+
+def _number_value(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        text = value.strip()
+        if not text:
+            return None
+        try:
+            number = float(text)
+        except ValueError:
+            return value
+        if number != number:
+            return value
+    elif isinstance(value, (int, float)):
+        number = value
+    else:
+        return normalize_value(value)
+    if isinstance(number, float):
+        if number != number:
+            return None
+        if number.is_integer() and abs(number) < 2 ** 63:
+            return int(number)
+    elif abs(number) >= 2 ** 63:
+        # BSON 只支援 64 位元整數
+        return float(number)
+    return number
+
+
+def _text_value(value):
+    if isinstance(value, str):
+        return value.strip() or None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return normalize_partno(value)
+    return normalize_value(value)
+
+
+VALUE_CONVERTERS = {"number": _number_value, "text": _text_value}
+
+
+def normalize_rows(names, rows, schema):
+    """
+    依 schema 逐欄轉換一批資料列（tuple，較短的列以 None 補齊），回傳可直接寫入的 list[dict]：
+    NaN 轉為 None，有 料號 欄位時加上 _partno，日期原始值存於 _raw。
+    """
+    names = list(names)
+    columns = list(zip(*(row + (None,) * (len(names) - len(row)) for row in rows)))
+    converted = []
+    raw = []
+    for name, values in zip(names, columns):
+        kind = schema.get(name)
+        if kind == "date":
+            out = []
+            for pos, value in enumerate(values):
+                parsed = parse_date(value)
+                if parsed is None:
+                    out.append(normalize_value(value))
+                    continue
+                if not isinstance(value, dt.date):
+                    raw.append((pos, name, value))
+                out.append(parsed)
+            converted.append(out)
+        else:
+            convert = VALUE_CONVERTERS.get(kind, normalize_value)
+            converted.append([convert(value) for value in values])
+        if name == "料號":
+            partno = [normalize_partno(value) for value in values]
+    if "料號" in names:
+        names.append(PARTNO_KEY)
+        converted.append(partno)
+    records = [dict(zip(names, row)) for row in zip(*converted)]
+    for pos, name, value in raw:
+        records[pos].setdefault(RAW_FIELD, {})[name] = value
+    return records
+
+
+def insert_chunk(coll, chunk, stats):
+    """
+    以 unordered insert_many 寫入一批資料；
+    寫入失敗的筆數記在 failed，前 MAX_IMPORT_ERRORS 則錯誤訊息記在 errors。
+    """
+    try:
+        inserted = len(coll.insert_many(chunk, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        inserted = e.details.get("nInserted", 0)
+        for err in e.details.get("writeErrors", []):
+            if len(stats["errors"]) < MAX_IMPORT_ERRORS:
+                stats["errors"].append(err.get("errmsg"))
+    stats["inserted"] += inserted
+    stats["failed"] += len(chunk) - inserted
+
+
+def ingest_excel(stream, coll, transform=None, chunk_size=None, after_insert=None, write_chunk=insert_chunk, sheet=None):
+    """
+    串流讀取 Excel 的 sheet（預設第一個）並分批以 write_chunk(coll, chunk, stats) 寫入 coll（預設 unordered insert_many）。
+    每批依 column_schema(coll) 逐欄轉換欄位型別；記憶體用量只與 chunk_size 有關，與檔案筆數無關。回傳匯入統計。
+    after_insert(chunk, stats) 會在每批寫入後呼叫，可用於回報進度。
+    """
+    schema = column_schema(coll)
+    chunk_size = chunk_size or IMPORT_CHUNK_SIZE
+    stats = {"parsed": 0, "inserted": 0, "failed": 0, "errors": [], "chunks": []}
+    started = time.perf_counter()
+    rows = iter_excel_rows(stream, sheet)
+    while True:
+        parse_started = time.perf_counter()
+        header, batch = None, []
+        for header, row in rows:
+            batch.append(row)
+            if len(batch) >= chunk_size:
+                break
+        if not batch:
+            break
+        chunk = normalize_rows(header, batch, schema)
+        if transform:
+            chunk = [transform(record) for record in chunk]
+        stats["parsed"] += len(chunk)
+        insert_started = time.perf_counter()
+        write_chunk(coll, chunk, stats)
+        finished = time.perf_counter()
+        stats["chunks"].append({
+            "rows": len(chunk),
+            "parse_ms": round((insert_started - parse_started) * 1000, 1),
+            "insert_ms": round((finished - insert_started) * 1000, 1),
+        })
+        elapsed = finished - started
+        stats["elapsed_ms"] = round(elapsed * 1000, 1)
+        stats["rows_per_sec"] = round(stats["inserted"] / elapsed, 1) if elapsed > 0 else None
+        if after_insert:
+            after_insert(chunk, stats)
+    elapsed = time.perf_counter() - started
+    stats["elapsed_ms"] = round(elapsed * 1000, 1)
+    stats["rows_per_sec"] = round(stats["inserted"] / elapsed, 1) if elapsed > 0 else None
+    return stats
+
+
+# 差異匯入：以自然鍵算出列鍵 _row_key、以內容算出雜湊 _row_hash，只寫入新增或內容有變的列
+ROW_KEY = "_row_key"
+ROW_HASH = "_row_hash"
+# 各資料庫預設的自然鍵欄位，可用 key 參數覆寫
+DELTA_KEY_DEFAULTS = {
+    PURCHASE_SHIPPING_COLLECTION_NAME: ["採購單號", "D W G"],
+    INVENTORY_NEED_COLLECTION_NAME: ["料號", "版本"],
+    CUSTOMER_NEED_COLLECTION_NAME: ["PO單號", "料號", "版本"],
+}
+
+
+def _row_digest(value):
+    return hashlib.sha1(json.dumps(value, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class DeltaImport:
+    """
+    差異匯入的寫入策略（傳給 ingest_excel 的 write_chunk）。
+    每批先以 _row_key 查出既有雜湊，新增列與內容變更的列以 ReplaceOne upsert 一次 bulk_write，
+    內容相同的列不寫入；retire() 刪除此次檔案中沒有出現的列。
+    自然鍵欄位全部空白的列不寫入，計為 failed（rejected 筆數），避免所有列雜湊成同一個鍵互相覆蓋。
+    """
+
+    def __init__(self, key_fields):
+        self.key_fields = key_fields
+        self.seen = set()
+        self.rejected = 0
+
+    def key_values(self, record):
+        values = []
+        for field in self.key_fields:
+            value = record.get(field)
+            if field == "料號":
+                value = normalize_partno(value)
+            values.append("" if value is None else str(value).strip())
+        return values
+
+    def row_key(self, record):
+        return _row_digest(self.key_values(record))
+
+    def __call__(self, coll, chunk, stats):
+        rows = {}
+        for record in chunk:
+            if not any(self.key_values(record)):
+                self.rejected += 1
+                stats["failed"] += 1
+                if len(stats["errors"]) < MAX_IMPORT_ERRORS:
+                    stats["errors"].append(f"自然鍵欄位 {', '.join(self.key_fields)} 皆為空白，略過此列")
+                continue
+            content = {k: v for k, v in record.items() if not k.startswith("_")}
+            record[ROW_KEY] = self.row_key(record)
+            record[ROW_HASH] = _row_digest(content)
+            if record[ROW_KEY] in rows or record[ROW_KEY] in self.seen:
+                stats["duplicate_keys"] = stats.get("duplicate_keys", 0) + 1
+            rows[record[ROW_KEY]] = record
+        self.seen.update(rows)
+        existing = {
+            doc[ROW_KEY]: doc.get(ROW_HASH)
+            for doc in coll.find({ROW_KEY: {"$in": list(rows)}}, {ROW_KEY: 1, ROW_HASH: 1, "_id": 0})
+        }
+        ops = [
+            ReplaceOne({ROW_KEY: key}, record, upsert=True)
+            for key, record in rows.items()
+            if existing.get(key) != record[ROW_HASH]
+        ]
+        stats["unchanged"] = stats.get("unchanged", 0) + len(rows) - len(ops)
+        if not ops:
+            return
+        try:
+            result = coll.bulk_write(ops, ordered=False)
+            upserted, modified = result.upserted_count, result.modified_count
+        except BulkWriteError as e:
+            upserted, modified = e.details.get("nUpserted", 0), e.details.get("nModified", 0)
+            for err in e.details.get("writeErrors", []):
+                if len(stats["errors"]) < MAX_IMPORT_ERRORS:
+                    stats["errors"].append(err.get("errmsg"))
+        stats["inserted"] += upserted
+        stats["updated"] = stats.get("updated", 0) + modified
+        stats["failed"] += len(ops) - upserted - modified
+
+    def retire(self, coll):
+        """刪除不在此次檔案中的列（含沒有 _row_key 的舊資料），回傳被刪除列的料號鍵。"""
+        retired_ids = []
+        partnos = set()
+        for doc in coll.find({}, {ROW_KEY: 1, PARTNO_KEY: 1}):
+            if doc.get(ROW_KEY) not in self.seen:
+                retired_ids.append(doc["_id"])
+                partnos.add(doc.get(PARTNO_KEY))
+        for i in range(0, len(retired_ids), IMPORT_CHUNK_SIZE):
+            coll.delete_many({"_id": {"$in": retired_ids[i:i + IMPORT_CHUNK_SIZE]}})
+        return len(retired_ids), partnos
+
+
+def import_excel(stream, coll, progress=None, options=None, sheet=None, finalize=True):
+    """
+    匯入 Excel 的 sheet（預設第一個）到 coll，完成後更新受影響料號的目錄並使快取失效。
+    同步上傳與背景工作共用；progress(stats) 會在每批寫入後呼叫。
+    options: {"mode": "append" | "delta", "key": [自然鍵欄位], "retire": bool}
+    finalize=False 時不更新目錄與快取，改將受影響的料號鍵放在 stats["partnos"]，由呼叫端合併後一次處理。
+    """
+    options = options or {}
+    partnos = set()
+    track_partnos = coll in CATALOG_SOURCES
+    delta = None
+    if options.get("mode") == "delta":
+        key_fields = options.get("key") or DELTA_KEY_DEFAULTS.get(coll.name)
+        if not key_fields:
+            raise ValueError("差異匯入需要指定 key（自然鍵欄位）")
+        delta = DeltaImport(key_fields)
+
+    def after_insert(chunk, stats):
+        if track_partnos:
+            partnos.update(r.get(PARTNO_KEY) for r in chunk)
+        if progress:
+            progress(stats)
+
+    stats = ingest_excel(stream, coll, after_insert=after_insert, write_chunk=delta or insert_chunk, sheet=sheet)
+    for outcome in ("inserted", "updated", "unchanged", "failed"):
+        if stats.get(outcome):
+            IMPORT_ROWS.labels(coll.name, outcome).inc(stats[outcome])
+    if delta:
+        stats["mode"] = "delta"
+        stats["key"] = delta.key_fields
+        if delta.rejected:
+            stats["rejected"] = delta.rejected
+        # 有列因自然鍵空白被略過時，檔案內容不完整，不刪除既有資料
+        if options.get("retire") and stats["parsed"] and delta.rejected:
+            stats["retire_skipped"] = True
+        elif options.get("retire") and stats["parsed"]:
+            stats["retired"], retired_partnos = delta.retire(coll)
+            partnos.update(retired_partnos)
+            IMPORT_ROWS.labels(coll.name, "retired").inc(stats["retired"])
+    logger.info("import_finished", extra={
+        "collection": coll.name, "mode": options.get("mode", "append"),
+        **{k: v for k, v in stats.items() if k not in ("chunks", "errors")},
+    })
+    changed = stats["inserted"] or stats.get("updated") or stats.get("retired")
+    if not finalize:
+        stats["partnos"] = sorted(key for key in partnos if key) if changed else []
+    elif changed:
+        refresh_catalog(partnos)
+        invalidate_cache()
+    return stats
+
+
+def import_options(values):
+    """從上傳請求的參數取出匯入選項：mode=delta、key=PO單號,料號,版本、retire=1。"""
+    options = {"mode": values.get("mode", "append")}
+    if values.get("key"):
+        options["key"] = [k.strip() for k in values["key"].split(",") if k.strip()]
+    options["retire"] = values.get("retire") in ("1", "true")
+    return options
+
+
+# 欄位式回應（format=columnar）：欄位名稱只列一次，值以欄為單位的陣列，以 orjson 序列化
+def columnar(rows, columns=None):
+    """
+    將 dict 列轉為 {"columns": [...], "values": [[第 1 欄的值...], ...], "length": n}。
+    未指定 columns 時取所有列的欄位聯集（依首次出現順序）。
+    """
+    if columns is None:
+        columns = list(dict.fromkeys(k for row in rows for k in row))
+    return {"columns": columns, "values": [[row.get(c) for row in rows] for c in columns], "length": len(rows)}
+
+
+def fast_jsonify(payload, status=200):
+    """以 orjson 序列化的 JSON 回應；datetime 輸出為 ISO 8601，NaN 輸出為 null。"""
+    body = orjson.dumps(payload, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+    return app.response_class(body, status=status, mimetype="application/json")
+
+
+# 回應壓縮：依 Accept-Encoding 協商 br / gzip，只壓縮非串流且超過 COMPRESS_MIN_SIZE 的文字回應
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_GZIP_LEVEL = int(os.environ.get("COMPRESS_GZIP_LEVEL", "5"))
+COMPRESS_BR_QUALITY = int(os.environ.get("COMPRESS_BR_QUALITY", "4"))
+COMPRESS_MIMETYPES = {"application/json", "text/html", "text/css", "text/javascript", "application/javascript"}
+
+
+@app.after_request
+def _compress_response(response):
+    if (
+        response.status_code != 200
+        or response.direct_passthrough
+        or response.is_streamed
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESS_MIMETYPES
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+    accepted = request.accept_encodings
+    if accepted["br"] and accepted["br"] >= accepted["gzip"]:
+        encoding, body = "br", brotli.compress(body, quality=COMPRESS_BR_QUALITY)
+    elif accepted["gzip"]:
+        encoding, body = "gzip", gzip.compress(body, compresslevel=COMPRESS_GZIP_LEVEL)
+    else:
+        return response
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    # 壓縮後的位元組與原本不同，ETag 改為 weak（If-None-Match 以 weak 比較，304 仍有效）
+    etag, _ = response.get_etag()
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+# 串流匯出：每次從 cursor 取 EXPORT_BATCH_SIZE 筆，邊讀邊輸出
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", "1000"))
+# /api/items 每頁預設筆數與上限；整個 collection 請用 format=ndjson / csv 串流匯出
+ITEMS_PAGE_SIZE = int(os.environ.get("ITEMS_PAGE_SIZE", "1000"))
+ITEMS_MAX_LIMIT = int(os.environ.get("ITEMS_MAX_LIMIT", "5000"))
+
+
+def _json_default(value):
+    if isinstance(value, (dt.datetime, dt.date)):
+        return value.isoformat()
+    return str(value)
+
+
+def _finite_json(value):
+    """NaN / Infinity 換成 None（遞迴處理 dict / list）。"""
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {k: _finite_json(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_finite_json(v) for v in value]
+    return value
+
+
+def _json_dumps(obj, **kwargs):
+    """
+    json.dumps，NaN / Infinity 輸出為 null（與 orjson 相同），避免產生瀏覽器無法解析的 JSON。
+    舊資料（未執行 normalize-types）才會有 NaN，一般情況只序列化一次。
+    """
+    try:
+        return json.dumps(obj, allow_nan=False, **kwargs)
+    except ValueError:
+        return json.dumps(_finite_json(obj), **kwargs)
+
+
+class IsoJSONProvider(DefaultJSONProvider):
+    """
+    jsonify 的日期也輸出為 ISO 8601（Flask 預設為 RFC 822）、NaN 輸出為 null，
+    與 fast_jsonify / NDJSON 匯出一致。
+    """
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, (dt.datetime, dt.date)):
+            return o.isoformat()
+        return DefaultJSONProvider.default(o)
+
+    def dumps(self, obj, **kwargs):
+        kwargs.setdefault("default", self.default)
+        kwargs.setdefault("ensure_ascii", self.ensure_ascii)
+        kwargs.setdefault("sort_keys", self.sort_keys)
+        return _json_dumps(obj, **kwargs)
+
+
+app.json = IsoJSONProvider(app)
+
+
+def stream_documents(cursor, fmt, name):
+    """
+    將 Mongo cursor 以 NDJSON 或 CSV 串流回應，記憶體只保留目前一批文件。
+    CSV 欄位以第一筆文件為準，並加上 BOM 讓 Excel 正確辨識 UTF-8。
+    """
+    def generate():
+        try:
+            header = None
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            for doc in cursor:
+                doc.pop("_id", None)
+                if fmt == "ndjson":
+                    yield _json_dumps(doc, ensure_ascii=False, default=_json_default) + "\n"
+                    continue
+                if header is None:
+                    header = list(doc)
+                    buf.write("\ufeff")
+                    writer.writerow(header)
+                writer.writerow([_csv_value(doc.get(k)) for k in header])
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        finally:
+            cursor.close()
+
+    mimetype = "application/x-ndjson" if fmt == "ndjson" else "text/csv"
+    resp = Response(generate(), mimetype=mimetype)
+    resp.headers["Content-Disposition"] = f"attachment; filename={name}.{fmt}"
+    return resp
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, (dt.datetime, dt.date)):
+        return value.isoformat()
+    return value
+
+
+def handle_excel_upload(coll):
+    """
+    四個上傳 API 共用：檢查表單檔案後串流匯入 coll。
+    帶 async=1（query 或表單欄位）時改為建立背景工作，立即回傳 202 與 job_id。
+    mode=delta 時以自然鍵差異匯入（key 指定欄位，retire=1 刪除檔案中已不存在的列）。
+    """
+    if "file" not in request.files:
+        return jsonify({"ok": False, "error": "No file part"}), 400
+    file = request.files["file"]
+    if file.filename == "":
+        return jsonify({"ok": False, "error": "No selected file"}), 400
+    options = import_options(request.values)
+    if options["mode"] not in ("append", "delta"):
+        return jsonify({"ok": False, "error": "mode 必須為 append 或 delta"}), 400
+    if options["mode"] == "delta" and not (options.get("key") or DELTA_KEY_DEFAULTS.get(coll.name)):
+        return jsonify({"ok": False, "error": "差異匯入需要指定 key（自然鍵欄位）"}), 400
+    try:
+        if request.values.get("async") in ("1", "true"):
+            job_id = submit_import_job(file, coll, options)
+            return jsonify({"ok": True, "job_id": job_id, "status_url": f"/api/jobs/{job_id}"}), 202
+        stats = import_excel(file.stream, coll, options=options)
+        if stats["parsed"] == 0:
+            return jsonify({"ok": False, "error": "Excel file contains no rows"}), 400
+        return jsonify({"ok": True, **stats})
+    except Exception as e:
+        return jsonify({"ok": False, "error": str(e)}), 500
+
+
+# 背景匯入工作：上傳檔案先存到暫存目錄，交給 process pool 解析與寫入，
+# 進度記錄在 import_jobs collection，任一 gunicorn worker 都能查詢
+IMPORT_JOBS_COLLECTION_NAME = os.environ.get("IMPORT_JOBS_COLLECTION_NAME", "import_jobs")
+import_jobs_collection = db[IMPORT_JOBS_COLLECTION_NAME]
+IMPORT_WORKERS = int(os.environ.get("IMPORT_WORKERS", "2"))
+IMPORT_TMP_DIR = os.environ.get("IMPORT_TMP_DIR") or tempfile.gettempdir()
+# 已結束的工作紀錄保留秒數
+IMPORT_JOB_TTL = int(os.environ.get("IMPORT_JOB_TTL", str(7 * 24 * 3600)))
+
+_import_pool = None
+_import_pool_lock = threading.Lock()
+
+
+def get_import_pool():
+    """延遲建立匯入用的 process pool（spawn，避免 fork 複製 MongoClient）。"""
+    global _import_pool
+    with _import_pool_lock:
+        if _import_pool is None:
+            _import_pool = ProcessPoolExecutor(
+                max_workers=IMPORT_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _import_pool
+
+
+def save_upload(file):
+    """將上傳檔案存到 IMPORT_TMP_DIR 的暫存檔，回傳路徑（由呼叫端負責刪除）。"""
+    fd, path = tempfile.mkstemp(suffix=".xlsx", dir=IMPORT_TMP_DIR)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            shutil.copyfileobj(file.stream, out)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+
+def submit_import_job(file, coll, options=None):
+    """將上傳檔案存到暫存檔並排入 process pool，回傳 job_id。"""
+    path = save_upload(file)
+    return _submit_job(path, run_import_job, {
+        "collection": coll.name,
+        "filename": secure_filename(file.filename),
+        "options": options or {},
+    }, coll.name, options)
+
+
+def submit_workbook_job(path, filename, targets, skipped, options=None):
+    """將已存好的活頁簿暫存檔排入 process pool，回傳 job_id；每個 sheet 的進度記在 sheets 陣列。"""
+    return _submit_job(path, run_workbook_job, {
+        "collection": None,
+        "filename": secure_filename(filename),
+        "options": options or {},
+        "sheets": [
+            {"sheet": sheet, "collection": name, "status": "queued", "rows_parsed": 0, "rows_inserted": 0, "rows_failed": 0}
+            for sheet, name in targets
+        ],
+        "skipped": skipped,
+    }, targets, options)
+
+
+def _submit_job(path, fn, fields, *args):
+    """
+    建立工作紀錄並以 fn(job_id, path, *args) 排入 process pool；暫存檔由工作結束時刪除。
+    建立紀錄或排入失敗時在此刪除暫存檔（呼叫端已將檔案交給此函式）。
+    """
+    job_id = uuid.uuid4().hex
+    created = False
+    try:
+        import_jobs_collection.insert_one({
+            "_id": job_id,
+            "status": "queued",
+            **fields,
+            "rows_parsed": 0,
+            "rows_inserted": 0,
+            "rows_failed": 0,
+            "errors": [],
+            "rows_per_sec": None,
+            "created_at": dt.datetime.now(dt.timezone.utc),
+        })
+        created = True
+        pool = get_import_pool()
+        future = pool.submit(fn, job_id, path, *args)
+    except Exception as e:
+        os.remove(path)
+        if created:
+            _finish_job(job_id, {"status": "failed", "error": str(e)})
+        raise
+    future.add_done_callback(functools.partial(_import_job_done, job_id, path, pool))
+    return job_id
+
+
+def _import_job_done(job_id, path, pool, future):
+    """
+    匯入工作的 future 結束時於 web process 中呼叫。
+    worker process 異常結束（OOM、BrokenProcessPool 等）時 run_import_job 來不及記錄結果，
+    在此將工作標記為 failed、刪除暫存檔；pool 已損壞時捨棄，下次上傳重新建立。
+    """
+    error = "匯入工作已取消" if future.cancelled() else future.exception()
+    if error is None:
+        return
+    global _import_pool
+    if isinstance(error, BrokenProcessPool):
+        with _import_pool_lock:
+            if _import_pool is pool:
+                _import_pool = None
+    logger.error("import_job_crashed", extra={"job_id": job_id, "error": str(error)})
+    _finish_job(job_id, {"status": "failed", "error": f"匯入 process 異常結束：{error}"})
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def run_import_job(job_id, path, collection_name, options=None):
+    """在 worker process 中執行：串流匯入暫存檔並持續更新工作進度。"""
+    import_jobs_collection.update_one(
+        {"_id": job_id}, {"$set": {"status": "running", "started_at": dt.datetime.now(dt.timezone.utc)}}
+    )
+
+    def progress(stats):
+        import_jobs_collection.update_one({"_id": job_id}, {"$set": _job_progress(stats)})
+
+    try:
+        with open(path, "rb") as f:
+            stats = import_excel(f, db[collection_name], progress, options)
+        update = {**_job_progress(stats), "status": "done", "elapsed_ms": stats["elapsed_ms"], "chunks": stats["chunks"]}
+        for field in ("updated", "unchanged", "retired", "duplicate_keys", "rejected"):
+            if field in stats:
+                update[f"rows_{field}"] = stats[field]
+        if stats.get("retire_skipped"):
+            update["retire_skipped"] = True
+        if stats["parsed"] == 0:
+            update.update(status="failed", error="Excel file contains no rows")
+        _finish_job(job_id, update)
+    except Exception as e:
+        _finish_job(job_id, {"status": "failed", "error": str(e)})
+    finally:
+        os.remove(path)
+
+
+def run_workbook_job(job_id, path, targets, options=None):
+    """
+    在 worker process 中執行：以 import_workbook 並行匯入各 sheet，
+    各 sheet 的進度由 sheet worker 寫入 sheets.<i>，全部完成後記錄合計與每個 sheet 的結果。
+    """
+    started = time.perf_counter()
+    import_jobs_collection.update_one(
+        {"_id": job_id}, {"$set": {"status": "running", "started_at": dt.datetime.now(dt.timezone.utc)}}
+    )
+    try:
+        sheets = import_workbook(path, targets, options, job_id=job_id)
+        update = {
+            "status": "done",
+            "ok": all(s["ok"] for s in sheets),
+            "sheets": [{**s, "status": "done" if s["ok"] else "failed"} for s in sheets],
+            "rows_parsed": sum(s.get("parsed", 0) for s in sheets),
+            "rows_inserted": sum(s.get("inserted", 0) for s in sheets),
+            "rows_failed": sum(s.get("failed", 0) for s in sheets),
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+        }
+        _finish_job(job_id, update)
+    except Exception as e:
+        _finish_job(job_id, {"status": "failed", "error": str(e)})
+    finally:
+        os.remove(path)
+
+
+def _job_progress(stats):
+    return {
+        "rows_parsed": stats["parsed"],
+        "rows_inserted": stats["inserted"],
+        "rows_failed": stats["failed"],
+        "errors": stats["errors"],
+        "rows_per_sec": stats.get("rows_per_sec"),
+    }
+
+
+def _finish_job(job_id, update):
+    """記錄工作結果；已結束的工作不會被覆寫（先記錄的結果為準）。"""
+    update["finished_at"] = dt.datetime.now(dt.timezone.utc)
+    import_jobs_collection.update_one({"_id": job_id, "finished_at": {"$exists": False}}, {"$set": update})
+
+
+# 多 sheet 活頁簿匯入：ERP 匯出的單一活頁簿含多張表，各 sheet 在 process pool 中並行解析與寫入
+WORKBOOK_WORKERS = int(os.environ.get("WORKBOOK_WORKERS", "3"))
+# 可作為匯入目標的資料庫
+UPLOAD_TARGETS = {
+    coll.name: coll
+    for coll in [collection, purchase_shipping_collection, inventory_need_collection, customer_need_collection]
+}
+# 未指定 mapping 時，依 sheet 名稱對應資料庫
+DEFAULT_SHEET_COLLECTIONS = {
+    "採購與出貨表": PURCHASE_SHIPPING_COLLECTION_NAME,
+    "FS訂單明細": PURCHASE_SHIPPING_COLLECTION_NAME,
+    "FS": PURCHASE_SHIPPING_COLLECTION_NAME,
+    "庫存與採購需求表": INVENTORY_NEED_COLLECTION_NAME,
+    "FS出貨庫存統計表": INVENTORY_NEED_COLLECTION_NAME,
+    "庫存表": INVENTORY_NEED_COLLECTION_NAME,
+    "客戶需求表": CUSTOMER_NEED_COLLECTION_NAME,
+    "FS需求表": CUSTOMER_NEED_COLLECTION_NAME,
+    "客戶需求": CUSTOMER_NEED_COLLECTION_NAME,
+}
+# sheet 名稱不認得時，依第一列欄位判斷（包含全部欄位即視為該表）
+DEFAULT_SHEET_SIGNATURES = [
+    ({"採購單號", "預計交期"}, PURCHASE_SHIPPING_COLLECTION_NAME),
+    ({"剩餘採購數量", "庫存"}, INVENTORY_NEED_COLLECTION_NAME),
+    ({"MIC需求起日"}, CUSTOMER_NEED_COLLECTION_NAME),
+]
+
+_sheet_pool = None
+_sheet_pool_lock = threading.Lock()
+
+
+def get_sheet_pool():
+    """延遲建立 sheet 解析用的 process pool（spawn），與背景匯入工作的 pool 分開，避免互相排隊。"""
+    global _sheet_pool
+    with _sheet_pool_lock:
+        if _sheet_pool is None:
+            _sheet_pool = ProcessPoolExecutor(
+                max_workers=WORKBOOK_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _sheet_pool
+
 
-# 新增客戶需求表匯入 API
-CUSTOMER_NEED_COLLECTION_NAME = os.environ.get("CUSTOMER_NEED_COLLECTION_NAME", "customer_need")
-customer_need_collection = db[CUSTOMER_NEED_COLLECTION_NAME]
+def _discard_sheet_pool(pool):
+    """sheet worker 異常結束（OOM、被 kill）後 pool 已無法使用，捨棄後下次重新建立。"""
+    global _sheet_pool
+    with _sheet_pool_lock:
+        if _sheet_pool is pool:
+            _sheet_pool = None
+            logger.error("sheet_pool_broken")
+
+
+def _submit_sheet(*args):
+    """
+    排入 sheet pool，回傳 (pool, future)；pool 已損壞時換一個新的 pool 重試一次，
+    仍然失敗時回傳帶有該例外的 future。
+    """
+    for attempt in range(2):
+        pool = get_sheet_pool()
+        try:
+            return pool, pool.submit(import_workbook_sheet, *args)
+        except BrokenProcessPool as e:
+            _discard_sheet_pool(pool)
+            error = e
+    future = Future()
+    future.set_exception(error)
+    return pool, future
+
+
+def resolve_sheet_mapping(path, mapping=None):
+    """
+    決定每個 sheet 匯入的資料庫，回傳 ([(sheet, collection 名稱)], [略過的 sheet])。
+    順序：mapping 指定（值為 null 表示略過）→ DEFAULT_SHEET_COLLECTIONS 名稱 → DEFAULT_SHEET_SIGNATURES 欄位。
+    """
+    mapping = mapping or {}
+    wb = load_workbook(path, read_only=True)
+    try:
+        titles = wb.sheetnames
+        missing = [name for name in mapping if name not in titles]
+        if missing:
+            raise ValueError(f"活頁簿中沒有 sheet：{', '.join(missing)}")
+        targets, skipped = [], []
+        for title in titles:
+            if title in mapping:
+                target = mapping[title]
+            else:
+                target = DEFAULT_SHEET_COLLECTIONS.get(title.strip())
+                if target is None:
+                    header = set(_excel_header(next(wb[title].iter_rows(max_row=1, values_only=True), ())))
+                    target = next((name for fields, name in DEFAULT_SHEET_SIGNATURES if fields <= header), None)
+            if not target:
+                skipped.append(title)
+            elif target not in UPLOAD_TARGETS:
+                raise ValueError(f"sheet {title} 的目標資料庫不存在：{target}")
+            else:
+                targets.append((title, target))
+        return targets, skipped
+    finally:
+        wb.close()
+
+
+def import_workbook_sheet(path, sheet, collection_name, options=None, job_id=None, index=None):
+    """
+    在 worker process 中執行：匯入活頁簿的單一 sheet，目錄更新與快取失效留給呼叫端合併處理。
+    有 job_id 時每批寫入後更新工作紀錄的 sheets.<index>。
+    """
+    progress = None
+    if job_id:
+        prefix = f"sheets.{index}."
+
+        def progress(stats):
+            update = {prefix + k: v for k, v in _job_progress(stats).items()}
+            import_jobs_collection.update_one({"_id": job_id}, {"$set": {**update, prefix + "status": "running"}})
+
+    with open(path, "rb") as f:
+        return import_excel(f, db[collection_name], progress, options, sheet=sheet, finalize=False)
+
+
+def import_workbook(path, targets, options=None, job_id=None):
+    """
+    並行匯入 targets 中的各 sheet，全部完成後一次更新料號目錄並使快取失效。
+    回傳每個 sheet 的統計（失敗的 sheet 含 error）；由背景工作呼叫時傳入 job_id 以記錄各 sheet 進度。
+    """
+    futures = [
+        (sheet, name, *_submit_sheet(path, sheet, name, options, job_id, i))
+        for i, (sheet, name) in enumerate(targets)
+    ]
+    results, partnos = [], set()
+    for i, (sheet, name, pool, future) in enumerate(futures):
+        try:
+            stats = future.result()
+        except BrokenProcessPool as e:
+            # 同一個 pool 中其他 sheet 的 future 也會以 BrokenProcessPool 結束，各自標記為失敗
+            _discard_sheet_pool(pool)
+            result = {"sheet": sheet, "collection": name, "ok": False, "error": f"sheet process 異常結束：{e}"}
+        except Exception as e:
+            result = {"sheet": sheet, "collection": name, "ok": False, "error": str(e)}
+        else:
+            partnos.update(stats.pop("partnos"))
+            chunks = stats.pop("chunks")
+            stats["parse_ms"] = round(sum(c["parse_ms"] for c in chunks), 1)
+            stats["insert_ms"] = round(sum(c["insert_ms"] for c in chunks), 1)
+            result = {"sheet": sheet, "collection": name, "ok": True, **stats}
+        results.append(result)
+        if job_id:
+            status = "done" if result["ok"] else "failed"
+            import_jobs_collection.update_one({"_id": job_id}, {"$set": {f"sheets.{i}": {**result, "status": status}}})
+    if any(r.get("inserted") or r.get("updated") or r.get("retired") for r in results):
+        refresh_catalog(partnos)
+        invalidate_cache()
+    return results
+
+
+# 庫存帳：每個料號一筆目前在庫數量，每次庫存異動以 $inc 原子更新
+STOCK_BALANCES_COLLECTION_NAME = os.environ.get("STOCK_BALANCES_COLLECTION_NAME", "stock_balances")
+stock_balances_collection = db[STOCK_BALANCES_COLLECTION_NAME]
+# 操作類型對在庫數量的增減方向
+STOCK_MOVEMENT_SIGNS = {"入庫": 1, "出庫": -1}
+# 客戶端提供的冪等鍵，stock_records 上有 unique index，重送同一筆異動不會重複記帳
+IDEMPOTENCY_KEY = "_idempotency_key"
+# 批次庫存異動 API 單次最多筆數
+STOCK_MOVEMENTS_MAX = int(os.environ.get("STOCK_MOVEMENTS_MAX", "1000"))
+
+
+def build_stock_record(data, kind="入庫"):
+    """
+    檢查庫存異動資料並組成 stock_records 文件，回傳 (record, error)。
+    必填欄位與 stock_in 相同：料號系列、料號、數量；數量必須大於 0，增減方向由 kind 決定。
+    """
+    for field in ["料號系列", "料號", "數量"]:
+        if data.get(field) in (None, ""):
+            return None, f"缺少必填欄位: {field}"
+    if kind not in STOCK_MOVEMENT_SIGNS:
+        return None, f"不支援的操作類型: {kind}"
+    quantity = to_number(data["數量"])
+    if quantity is None:
+        return None, "數量必須為數字"
+    # 增減方向由操作類型決定，數量一律為正數（負數入庫會變成扣庫存）
+    if not quantity > 0:
+        return None, "數量必須大於 0"
+    record = {
+        "料號系列": data["料號系列"],
+        "料號": data["料號"],
+        PARTNO_KEY: normalize_partno(data["料號"]),
+        "產品中文名稱": data.get("產品中文名稱", ""),
+        "數量": quantity,
+        "單價": data.get("單價"),
+        f"{kind}時間": dt.datetime.now().isoformat(),
+        "操作類型": kind,
+    }
+    idempotency_key = data.get("idempotency_key")
+    if idempotency_key:
+        record[IDEMPOTENCY_KEY] = str(idempotency_key)
+    return record, None
+
+
+def record_stock_movements(records):
+    """
+    以一次 unordered insert_many 寫入庫存異動，冪等鍵重複者視為已記帳。
+    只有新寫入的異動會更新庫存帳與料號目錄。回傳每筆的狀態：
+    ("created", _id) / ("duplicate", 既有 _id) / ("failed", 錯誤訊息)。
+    異動紀錄與庫存帳是兩次獨立寫入（docker-compose 的 mongod 為單機，不支援 transaction）：
+    若在兩者之間中斷，stock_records 為準，以 flask rebuild-balances 重算庫存帳即可修正。
+    """
+    outcomes = [("created", None)] * len(records)
+    try:
+        stock_records_collection.insert_many(records, ordered=False)
+    except BulkWriteError as e:
+        for err in e.details.get("writeErrors", []):
+            if err.get("code") == 11000 and IDEMPOTENCY_KEY in records[err["index"]]:
+                outcomes[err["index"]] = ("duplicate", None)
+            else:
+                outcomes[err["index"]] = ("failed", err.get("errmsg"))
+    duplicate_keys = [r[IDEMPOTENCY_KEY] for r, (status, _) in zip(records, outcomes) if status == "duplicate"]
+    existing = {}
+    if duplicate_keys:
+        for doc in stock_records_collection.find({IDEMPOTENCY_KEY: {"$in": duplicate_keys}}, {IDEMPOTENCY_KEY: 1}):
+            existing[doc[IDEMPOTENCY_KEY]] = doc["_id"]
+    created = []
+    for i, (record, (status, detail)) in enumerate(zip(records, outcomes)):
+        if status == "created":
+            outcomes[i] = ("created", record["_id"])
+            created.append(record)
+        elif status == "duplicate":
+            outcomes[i] = ("duplicate", existing.get(record[IDEMPOTENCY_KEY]))
+    if created:
+        apply_stock_movements(created)
+        refresh_catalog([r[PARTNO_KEY] for r in created])
+        invalidate_cache()
+    return outcomes
+
+
+def to_number(value):
+    """將數量轉為 int / float；無法轉換時回傳 None。"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        number = value
+    else:
+        try:
+            number = float(str(value).strip())
+        except ValueError:
+            return None
+    if number != number:
+        return None
+    return int(number) if float(number).is_integer() else number
+
+
+def apply_stock_movements(records):
+    """依庫存異動紀錄以一次 bulk_write 更新 stock_balances。"""
+    now = dt.datetime.now(dt.timezone.utc)
+    ops = [
+        UpdateOne(
+            {"_id": r[PARTNO_KEY]},
+            {
+                "$inc": {"庫存": STOCK_MOVEMENT_SIGNS[r["操作類型"]] * r["數量"]},
+                "$set": {"料號": r["料號"], "料號系列": r["料號系列"], "updated_at": now},
+            },
+            upsert=True,
+        )
+        for r in records
+    ]
+    if ops:
+        stock_balances_collection.bulk_write(ops, ordered=False)
+
+
+def stock_on_hand(keys):
+    """以一次 $in 查詢料號的目前在庫數量，回傳 {料號鍵: 庫存}；沒有庫存帳的料號不在結果中。"""
+    keys = [key for key in keys if key]
+    if not keys:
+        return {}
+    return {
+        doc["_id"]: doc.get("庫存", 0)
+        for doc in stock_balances_collection.find({"_id": {"$in": keys}}, {"庫存": 1})
+    }
+
+
+# 撿貨資料查詢：撿貨資訊表與出貨單共用
+PICK_FIELDS = ["MIC需求起日", "MIC需求訖日", "料號", "版本", "產品中文名稱", "數量", "單價", "PO單號", "庫存"]
+# 撿貨資訊表每頁預設筆數與上限
+PICK_PAGE_SIZE = int(os.environ.get("PICK_PAGE_SIZE", "500"))
+PICK_MAX_LIMIT = int(os.environ.get("PICK_MAX_LIMIT", "5000"))
+
+
+def pick_date_query(mic_start, mic_end):
+    """
+    MIC需求起日 區間（含兩端日期）的查詢條件；日期無法解析時回傳 None。
+    MIC需求起日 於匯入時已存成日期，直接以索引範圍查詢。
+    """
+    start_dt = parse_date(mic_start)
+    end_dt = parse_date(mic_end)
+    if not start_dt or not end_dt:
+        return None
+    day_start = start_dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    next_day = end_dt.replace(hour=0, minute=0, second=0, microsecond=0) + dt.timedelta(days=1)
+    return {"MIC需求起日": {"$gte": day_start, "$lt": next_day}}
+
+
+def pick_pipeline(query, sort_field="MIC需求起日", sort_order="asc", skip=0, limit=None):
+    """
+    以 $unionWith 合併三個撿貨資料庫的單一 aggregation：
+    各資料庫先以索引 $match，再於伺服器端依 sort_field 全域排序並分頁。
+    """
+    branch = [{"$match": query}, {"$project": {f: 1 for f in PICK_FIELDS}}]
+    pipeline = list(branch)
+    for coll in PICK_COLLECTIONS[1:]:
+        pipeline.append({"$unionWith": {"coll": coll.name, "pipeline": branch}})
+    if sort_field not in PICK_FIELDS:
+        sort_field = "MIC需求起日"
+    direction = -1 if sort_order == "desc" else 1
+    pipeline.append({"$sort": {sort_field: direction, "_id": 1}})
+    if skip:
+        pipeline.append({"$skip": skip})
+    if limit:
+        pipeline.append({"$limit": limit})
+    return pipeline
+
+
+def find_pick_rows(query, sort_field="MIC需求起日", sort_order="asc", skip=0, limit=None):
+    """
+    搜尋三個撿貨資料庫並全域排序、分頁，
+    日期格式化為 YYYY-MM-DD，並以料號補上 產品中文名稱、單價、庫存（有庫存帳時以庫存帳為準）。
+    """
+    pipeline = pick_pipeline(query, sort_field, sort_order, skip, limit)
+    started = time.perf_counter()
+    pick_results = list(PICK_COLLECTIONS[0].aggregate(pipeline, allowDiskUse=True))
+    logger.debug("pick_search", extra={
+        "pipeline": pipeline, "rows": len(pick_results),
+        "aggregate_ms": round((time.perf_counter() - started) * 1000, 1),
+    })
+    for d in pick_results:
+        d.pop("_id", None)
+        for date_field in DATE_FIELDS:
+            if isinstance(d.get(date_field), dt.datetime):
+                d[date_field] = d[date_field].strftime("%Y-%m-%d")
+            elif date_field in d and isinstance(d[date_field], str):
+                d[date_field] = d[date_field].split('T')[0]
+    # 以料號批次搜尋所有資料庫，取得 產品中文名稱、單價、庫存
+    enrich_fields = ["產品中文名稱", "單價", "庫存"]
+    partnos = {normalize_partno(row.get("料號")) for row in pick_results if row.get("料號")}
+    enrich_data = lookup_product_fields(partnos, enrich_fields)
+    for key, quantity in stock_on_hand(partnos).items():
+        enrich_data[key]["庫存"] = quantity
+    # 合併 enrich_data 到 pick_results
+    for row in pick_results:
+        partno = row.get("料號")
+        info = enrich_data.get(normalize_partno(partno)) if partno else None
+        if info:
+            row.update(info)
+    return pick_results
+
+
+# 出貨單產生：shipping_template.xlsx 只載入一次，擷取版面後以 write-only 模式逐張輸出
+SHIPPING_TEMPLATE_PATH = os.path.join(app.static_folder, "shipping_template.xlsx")
+# 串流回應每次輸出的位元組數
+STREAM_CHUNK_SIZE = 64 * 1024
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+class ShippingSlipTemplate:
+    """
+    shipping_template.xlsx 第一個 sheet 的版面：每格的值與樣式、欄寬、列高、合併儲存格。
+    品項列位於「NO.」標題列與「合計」列之間，品項超過範本列數時沿用品項列樣式往下延伸。
+    """
+
+    STYLE_ATTRS = ("font", "border", "fill", "number_format", "alignment", "protection")
+
+    def __init__(self, path):
+        wb = load_workbook(path)
+        ws = wb.worksheets[0]
+        self.column_widths = {key: dim.width for key, dim in ws.column_dimensions.items() if dim.width}
+        self.rows = []
+        for row in ws.iter_rows(min_row=1, max_row=ws.max_row, max_col=ws.max_column):
+            height = ws.row_dimensions[row[0].row].height
+            cells = [(cell.value, {attr: copy(getattr(cell, attr)) for attr in self.STYLE_ATTRS}) for cell in row]
+            self.rows.append((height, cells))
+        self.merged = [CellRange(str(rng)) for rng in ws.merged_cells.ranges]
+        wb.close()
+
+        labels = {}
+        for r, (_, cells) in enumerate(self.rows, start=1):
+            for c, (value, _) in enumerate(cells):
+                if isinstance(value, str):
+                    labels.setdefault(re.sub(r"\s", "", value), (r, c))
+        self.header_row = labels["NO."][0]
+        self.total_row = labels["合計"][0]
+        self.columns = {
+            re.sub(r"\s", "", str(value)): c
+            for c, (value, _) in enumerate(self.rows[self.header_row - 1][1]) if value is not None
+        }
+        # 「出貨日期」「單據編號」標籤右邊一格填值
+        self.fields = {name: (labels[name][0], labels[name][1] + 1) for name in ("出貨日期", "單據編號") if name in labels}
+
+    def render(self, ws, po_number, items, ship_date):
+        """將一張出貨單寫入 write-only worksheet。"""
+        first_item = self.header_row + 1
+        template_items = self.total_row - first_item
+        extra = max(len(items) - template_items, 0)
+        last_item = self.total_row - 1 + extra
+        values = {self.fields[name]: value for name, value in (("出貨日期", ship_date), ("單據編號", po_number)) if name in self.fields}
+
+        for letter, width in self.column_widths.items():
+            ws.column_dimensions[letter].width = width
+        for rng in self.merged:
+            rng = copy(rng)
+            if rng.min_row > self.total_row - 1:
+                rng.shift(row_shift=extra)
+            ws.merged_cells.add(rng)
+
+        out_row = 0
+        for r, (height, cells) in enumerate(self.rows, start=1):
+            if r == first_item:
+                for i in range(template_items + extra):
+                    out_row += 1
+                    # 最後一列沿用範本最後一個品項列（底框線），其餘沿用一般品項列
+                    if i == template_items + extra - 1:
+                        src = self.total_row - 1
+                    else:
+                        src = first_item + min(i, template_items - 2)
+                    src_height, src_cells = self.rows[src - 1]
+                    item = items[i] if i < len(items) else None
+                    ws.row_dimensions[out_row].height = src_height
+                    ws.append([self._cell(ws, value, style) for value, style in self._item_cells(src_cells, item, i, out_row)])
+                continue
+            if first_item < r < self.total_row:
+                continue
+            out_row += 1
+            if height:
+                ws.row_dimensions[out_row].height = height
+            row = []
+            for c, (value, style) in enumerate(cells):
+                value = values.get((r, c), value)
+                if r == self.total_row and isinstance(value, str) and value.upper().startswith("=SUM("):
+                    col = re.search(r"\(([A-Z]+)\d+", value.upper()).group(1)
+                    value = f"=SUM({col}{first_item}:{col}{last_item})"
+                row.append(self._cell(ws, value, style))
+            ws.append(row)
+
+    def _item_cells(self, src_cells, item, i, out_row):
+        cells = [[None, style] for _, style in src_cells]
+        if item is None:
+            return cells
+        columns = self.columns
+        # 舊資料的 版本 可能是數值（含 0）
+        product = " ".join(str(v) for v in (normalize_partno(item.get("料號")), item.get("版本")) if v not in (None, ""))
+        fill = {
+            "NO.": f"{i + 1:02d}",
+            "品名": item.get("產品中文名稱") or product,
+            "數量": item.get("數量"),
+            "單價": item.get("單價"),
+            "備註": product,
+        }
+        for name, value in fill.items():
+            if name in columns:
+                cells[columns[name]][0] = value
+        if {"數量", "單價", "小計"} <= set(columns):
+            qty = _column_letter(columns["數量"])
+            price = _column_letter(columns["單價"])
+            cells[columns["小計"]][0] = f"={qty}{out_row}*{price}{out_row}"
+        return cells
+
+    @staticmethod
+    def _cell(ws, value, style):
+        cell = WriteOnlyCell(ws, value=value)
+        for attr, val in style.items():
+            setattr(cell, attr, val)
+        return cell
+
+
+def _column_letter(index):
+    letters = ""
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+_shipping_template = None
+_shipping_template_lock = threading.Lock()
+
+
+def get_shipping_template():
+    """延遲載入出貨單範本，之後重複使用。"""
+    global _shipping_template
+    with _shipping_template_lock:
+        if _shipping_template is None:
+            _shipping_template = ShippingSlipTemplate(SHIPPING_TEMPLATE_PATH)
+        return _shipping_template
+
+
+def _slip_sheet_title(po_number, used):
+    title = re.sub(r"[\\/*?:\[\]]", "_", str(po_number))[:31] or "出貨單"
+    base, n = title, 1
+    while title in used:
+        n += 1
+        suffix = f"_{n}"
+        title = base[:31 - len(suffix)] + suffix
+    used.add(title)
+    return title
+
+
+def group_pick_rows_by_po(rows):
+    """依 PO單號 分組（保留出現順序），沒有 PO單號 的列略過。"""
+    groups = OrderedDict()
+    for row in rows:
+        po_number = row.get("PO單號")
+        if po_number not in (None, ""):
+            groups.setdefault(str(po_number), []).append(row)
+    return groups
+
+
+def stream_slips_workbook(groups, ship_date):
+    """
+    所有出貨單寫入同一個 write-only 活頁簿（每個 PO 一個 sheet），
+    存到暫存檔後回傳分段串流的 Response。暫存檔在回應關閉時刪除，
+    用戶端中途斷線或回應沒有被讀取時也不會殘留。
+    """
+    template = get_shipping_template()
+    wb = Workbook(write_only=True)
+    used = set()
+    for po_number, items in groups.items():
+        template.render(wb.create_sheet(_slip_sheet_title(po_number, used)), po_number, items, ship_date)
+    fd, path = tempfile.mkstemp(suffix=".xlsx", dir=IMPORT_TMP_DIR)
+    os.close(fd)
+    try:
+        wb.save(path)
+        resp = Response(_read_file_chunks(path), mimetype=XLSX_MIMETYPE)
+    except Exception:
+        os.remove(path)
+        raise
+    resp.call_on_close(functools.partial(_remove_file, path))
+    return resp
+
+
+def _read_file_chunks(path):
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(STREAM_CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class _ZipSink:
+    """給 zipfile 寫入的非 seekable 緩衝區，寫入的資料由 drain() 取出後串流。"""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+def stream_slips_zip(groups, ship_date):
+    """每個 PO 產生一個出貨單活頁簿，逐一加入 ZIP 並立即串流，同時只保留一張在記憶體。"""
+    template = get_shipping_template()
+
+    def generate():
+        sink = _ZipSink()
+        used = set()
+        with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED) as zf:
+            for po_number, items in groups.items():
+                title = _slip_sheet_title(po_number, used)
+                wb = Workbook(write_only=True)
+                template.render(wb.create_sheet(title), po_number, items, ship_date)
+                buf = io.BytesIO()
+                wb.save(buf)
+                zf.writestr(f"{title}.xlsx", buf.getvalue())
+                yield sink.drain()
+        yield sink.drain()
+
+    return generate()
 
 
 @app.route("/")
@@ -34,44 +1903,104 @@ def index():
 
 @app.route("/api/items", methods=["GET"])
 def get_items():
-    # Return all documents (limit to 1000 by default to avoid huge responses)
-    limit = int(request.args.get("limit", "1000"))
-    docs = list(collection.find({}, {"_id": 0}).limit(limit))
-    return jsonify({"count": len(docs), "items": docs})
+    """
+    Returns documents in _id order, one page at a time (keyset pagination).
+    Query params: limit (default ITEMS_PAGE_SIZE, capped at ITEMS_MAX_LIMIT), after (the "next" token of the previous page),
+    format=ndjson|csv streams every document after the cursor instead of one page;
+    format=columnar returns the page as column arrays (see columnar()).
+    """
+    query = {}
+    after = request.args.get("after")
+    if after:
+        try:
+            query["_id"] = {"$gt": ObjectId(after)}
+        except InvalidId:
+            return jsonify({"ok": False, "error": "Invalid after token"}), 400
+    projection = {PARTNO_KEY: 0, RAW_FIELD: 0, ROW_KEY: 0, ROW_HASH: 0}
+
+    fmt = request.args.get("format", "json")
+    if fmt in ("ndjson", "csv"):
+        cursor = collection.find(query, projection).sort("_id", 1).batch_size(EXPORT_BATCH_SIZE)
+        return stream_documents(cursor, fmt, COLLECTION_NAME)
+
+    try:
+        limit = min(max(int(request.args.get("limit", ITEMS_PAGE_SIZE)), 1), ITEMS_MAX_LIMIT)
+    except ValueError:
+        return jsonify({"ok": False, "error": "limit must be an integer"}), 400
+    docs = list(collection.find(query, projection).sort("_id", 1).limit(limit))
+    next_token = str(docs[-1]["_id"]) if docs and len(docs) == limit else None
+    for doc in docs:
+        doc.pop("_id")
+    if fmt == "columnar":
+        return fast_jsonify({"count": len(docs), "format": "columnar", "items": columnar(docs), "next": next_token})
+    return jsonify({"count": len(docs), "items": docs, "next": next_token})
 
 
 @app.route("/api/upload", methods=["POST"])
 def upload_excel():
     """
     Expects a form-data request with a file field named 'file'.
-    Reads the first sheet of the Excel file and inserts rows into MongoDB.
+    Streams the first sheet of the Excel file into MongoDB in chunks.
+    """
+    return handle_excel_upload(collection)
+
+
+@app.route("/api/upload_workbook", methods=["POST"])
+def upload_workbook():
+    """
+    上傳含多個 sheet 的活頁簿，一次匯入多個資料庫。
+    form: file, mapping (JSON {"sheet 名稱": "資料庫名稱" 或 null}，未列出的 sheet 依名稱或欄位自動判斷)，
+    mode / key / retire 同其他上傳 API，套用到每個 sheet。回傳每個 sheet 的筆數與耗時。
+    帶 async=1 時檢查 mapping 後建立背景工作，立即回傳 202 與 job_id（大型活頁簿請使用，避免超過 gunicorn timeout）。
     """
     if "file" not in request.files:
         return jsonify({"ok": False, "error": "No file part"}), 400
     file = request.files["file"]
     if file.filename == "":
         return jsonify({"ok": False, "error": "No selected file"}), 400
-
-    filename = secure_filename(file.filename)
+    options = import_options(request.values)
+    if options["mode"] not in ("append", "delta"):
+        return jsonify({"ok": False, "error": "mode 必須為 append 或 delta"}), 400
     try:
-        # Read file bytes into pandas
-        in_memory = io.BytesIO(file.read())
-        df = pd.read_excel(in_memory, engine="openpyxl")
-
-        # Normalize dataframe: convert NaN to None
-        df = df.where(pd.notnull(df), None)
+        mapping = json.loads(request.values.get("mapping") or "{}")
+    except ValueError:
+        return jsonify({"ok": False, "error": "mapping 必須為 JSON 物件"}), 400
+    if not isinstance(mapping, dict):
+        return jsonify({"ok": False, "error": "mapping 必須為 JSON 物件"}), 400
 
-        # Convert to list of dicts
-        records = df.to_dict(orient="records")
-        if len(records) == 0:
-            return jsonify({"ok": False, "error": "Excel file contains no rows"}), 400
-
-        # Insert into MongoDB
-        result = collection.insert_many(records)
-        inserted = len(result.inserted_ids)
-        return jsonify({"ok": True, "inserted": inserted})
+    started = time.perf_counter()
+    path = save_upload(file)
+    queued = False
+    try:
+        try:
+            targets, skipped = resolve_sheet_mapping(path, mapping)
+        except ValueError as e:
+            return jsonify({"ok": False, "error": str(e)}), 400
+        if not targets:
+            return jsonify({"ok": False, "error": "活頁簿中沒有可匯入的 sheet", "skipped": skipped}), 400
+        if options["mode"] == "delta":
+            names = [name for _, name in targets]
+            if any(not (options.get("key") or DELTA_KEY_DEFAULTS.get(name)) for name in names):
+                return jsonify({"ok": False, "error": "差異匯入需要指定 key（自然鍵欄位）"}), 400
+            if options["retire"] and len(set(names)) < len(names):
+                return jsonify({"ok": False, "error": "retire=1 時每個資料庫只能對應一個 sheet"}), 400
+        if request.values.get("async") in ("1", "true"):
+            # 暫存檔交由背景工作刪除
+            queued = True
+            job_id = submit_workbook_job(path, file.filename, targets, skipped, options)
+            return jsonify({"ok": True, "job_id": job_id, "status_url": f"/api/jobs/{job_id}", "skipped": skipped}), 202
+        sheets = import_workbook(path, targets, options)
+        return jsonify({
+            "ok": all(s["ok"] for s in sheets),
+            "sheets": sheets,
+            "skipped": skipped,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+        })
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
+    finally:
+        if not queued:
+            os.remove(path)
 
 
 @app.route("/api/clear", methods=["POST"])
@@ -87,6 +2016,7 @@ def clear_db():
     try:
         # Option 1: drop the collection
         collection.drop()
+        invalidate_cache()
         return jsonify({"ok": True, "message": f"Collection '{COLLECTION_NAME}' dropped."})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
@@ -97,23 +2027,7 @@ def upload_purchase_shipping_excel():
     """
     上傳 Excel 檔案並匯入採購與出貨表。
     """
-    if "file" not in request.files:
-        return jsonify({"ok": False, "error": "No file part"}), 400
-    file = request.files["file"]
-    if file.filename == "":
-        return jsonify({"ok": False, "error": "No selected file"}), 400
-    try:
-        in_memory = io.BytesIO(file.read())
-        df = pd.read_excel(in_memory, engine="openpyxl")
-        df = df.where(pd.notnull(df), None)
-        records = df.to_dict(orient="records")
-        if len(records) == 0:
-            return jsonify({"ok": False, "error": "Excel file contains no rows"}), 400
-        result = purchase_shipping_collection.insert_many(records)
-        inserted = len(result.inserted_ids)
-        return jsonify({"ok": True, "inserted": inserted})
-    except Exception as e:
-        return jsonify({"ok": False, "error": str(e)}), 500
+    return handle_excel_upload(purchase_shipping_collection)
 
 
 @app.route("/api/upload_inventory_need", methods=["POST"])
@@ -121,23 +2035,7 @@ def upload_inventory_need_excel():
     """
     上傳 Excel 檔案並匯入庫存與採購需求表。
     """
-    if "file" not in request.files:
-        return jsonify({"ok": False, "error": "No file part"}), 400
-    file = request.files["file"]
-    if file.filename == "":
-        return jsonify({"ok": False, "error": "No selected file"}), 400
-    try:
-        in_memory = io.BytesIO(file.read())
-        df = pd.read_excel(in_memory, engine="openpyxl")
-        df = df.where(pd.notnull(df), None)
-        records = df.to_dict(orient="records")
-        if len(records) == 0:
-            return jsonify({"ok": False, "error": "Excel file contains no rows"}), 400
-        result = inventory_need_collection.insert_many(records)
-        inserted = len(result.inserted_ids)
-        return jsonify({"ok": True, "inserted": inserted})
-    except Exception as e:
-        return jsonify({"ok": False, "error": str(e)}), 500
+    return handle_excel_upload(inventory_need_collection)
 
 
 @app.route("/api/upload_customer_need", methods=["POST"])
@@ -145,54 +2043,20 @@ def upload_customer_need_excel():
     """
     上傳 Excel 檔案並匯入客戶需求表。
     """
-    if "file" not in request.files:
-        return jsonify({"ok": False, "error": "No file part"}), 400
-    file = request.files["file"]
-    if file.filename == "":
-        return jsonify({"ok": False, "error": "No selected file"}), 400
-    try:
-        in_memory = io.BytesIO(file.read())
-        df = pd.read_excel(in_memory, engine="openpyxl")
-        # 將 NaT 及 datetime 欄位全部轉為 None 或 ISO 格式字串
-        for col in df.columns:
-            if pd.api.types.is_datetime64_any_dtype(df[col]):
-                df[col] = df[col].apply(lambda x: x.isoformat() if not pd.isna(x) and hasattr(x, 'isoformat') else None)
-            else:
-                df[col] = df[col].apply(lambda x: None if pd.isna(x) else x)
-        records = df.to_dict(orient="records")
-        if len(records) == 0:
-            return jsonify({"ok": False, "error": "Excel file contains no rows"}), 400
-        result = customer_need_collection.insert_many(records)
-        inserted = len(result.inserted_ids)
-        return jsonify({"ok": True, "inserted": inserted})
-    except Exception as e:
-        return jsonify({"ok": False, "error": str(e)}), 500
+    return handle_excel_upload(customer_need_collection)
 
 
 # 獲取料號系列 API
 @app.route("/api/product_series", methods=["GET"])
+@cached_response
 def get_product_series():
     """
     獲取所有料號系列 (去重複)
     """
     try:
-        # 從多個collection中取得料號系列
-        series_set = set()
-        
-        # 從products collection取得
-        PRODUCTS_COLLECTION_NAME = os.environ.get("PRODUCTS_COLLECTION_NAME", "products")
-        products_collection = db[PRODUCTS_COLLECTION_NAME]
-        
-        for coll in [products_collection, purchase_shipping_collection, inventory_need_collection, customer_need_collection]:
-            try:
-                series_docs = coll.distinct("料號系列")
-                for series in series_docs:
-                    if series and str(series).strip():
-                        series_set.add(str(series).strip())
-            except:
-                continue
-                
-        series_list = sorted(list(series_set))
+        # 從料號目錄取得（上傳與入庫時增量更新）
+        series_docs = catalog_collection.distinct("料號系列")
+        series_list = sorted(series_docs)
         return jsonify({"ok": True, "series": series_list})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
@@ -200,6 +2064,7 @@ def get_product_series():
 
 # 根據料號系列獲取料號 API
 @app.route("/api/product_numbers", methods=["GET"])
+@cached_response
 def get_product_numbers():
     """
     根據料號系列獲取料號列表
@@ -210,24 +2075,8 @@ def get_product_numbers():
         if not series:
             return jsonify({"ok": False, "error": "缺少料號系列參數"}), 400
             
-        numbers_set = set()
-        
-        # 從products collection取得
-        PRODUCTS_COLLECTION_NAME = os.environ.get("PRODUCTS_COLLECTION_NAME", "products")
-        products_collection = db[PRODUCTS_COLLECTION_NAME]
-        
-        for coll in [products_collection, purchase_shipping_collection, inventory_need_collection, customer_need_collection]:
-            try:
-                query = {"料號系列": series}
-                docs = coll.find(query, {"料號": 1, "_id": 0})
-                for doc in docs:
-                    number = doc.get("料號")
-                    if number and str(number).strip():
-                        numbers_set.add(str(number).strip())
-            except:
-                continue
-                
-        numbers_list = sorted(list(numbers_set))
+        docs = catalog_collection.find({"料號系列": series.strip()}, {"料號": 1, "_id": 0})
+        numbers_list = sorted(doc["料號"] for doc in docs)
         return jsonify({"ok": True, "numbers": numbers_list})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
@@ -235,6 +2084,7 @@ def get_product_numbers():
 
 # 根據料號獲取產品資訊 API
 @app.route("/api/product_info", methods=["GET"])
+@cached_response
 def get_product_info():
     """
     根據料號獲取產品中文名稱等資訊
@@ -245,55 +2095,33 @@ def get_product_info():
         if not number:
             return jsonify({"ok": False, "error": "缺少料號參數"}), 400
             
-        # 從多個collection中搜尋產品資訊
-        product_info = {}
-        
-        PRODUCTS_COLLECTION_NAME = os.environ.get("PRODUCTS_COLLECTION_NAME", "products")
-        products_collection = db[PRODUCTS_COLLECTION_NAME]
-        
-        search_collections = [products_collection, purchase_shipping_collection, inventory_need_collection, customer_need_collection]
-        
-        for coll in search_collections:
-            try:
-                # 嘗試多種料號格式
-                queries = [
-                    {"料號": number},
-                    {"料號": str(number)},
-                ]
-                
-                # 如果是數字，也嘗試數字格式
-                try:
-                    num_value = float(number)
-                    queries.append({"料號": num_value})
-                    queries.append({"料號": int(num_value)})
-                except:
-                    pass
-                
-                for query in queries:
-                    doc = coll.find_one(query, {"產品中文名稱": 1, "單價": 1, "庫存": 1, "_id": 0})
-                    if doc:
-                        for field in ["產品中文名稱", "單價", "庫存"]:
-                            if field in doc and doc[field] is not None and field not in product_info:
-                                import math
-                                val = doc[field]
-                                if isinstance(val, float) and math.isnan(val):
-                                    continue
-                                product_info[field] = val
-                        
-                        # 如果已找到所需資訊就跳出
-                        if "產品中文名稱" in product_info:
-                            break
-                            
-                if "產品中文名稱" in product_info:
-                    break
-            except:
-                continue
-                
+        key = normalize_partno(number)
+        doc = catalog_collection.find_one({"_id": key}, {f: 1 for f in CATALOG_FIELDS})
+        product_info = {f: doc[f] for f in CATALOG_FIELDS if doc and doc.get(f) is not None}
+        # 庫存以庫存帳為準（目錄在 rebuild-catalog 前可能仍是匯入資料的值）
+        on_hand = stock_on_hand([key])
+        if key in on_hand:
+            product_info["庫存"] = on_hand[key]
+
         return jsonify({"ok": True, "product_info": product_info})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
 
+# 背景匯入工作狀態 API
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def get_import_job(job_id):
+    """
+    查詢背景匯入工作：status (queued / running / done / failed)、
+    rows_parsed、rows_inserted、rows_failed、errors、rows_per_sec。
+    活頁簿工作另有 sheets（每個 sheet 的 status 與筆數）與 skipped。
+    """
+    job = import_jobs_collection.find_one({"_id": job_id})
+    if not job:
+        return jsonify({"ok": False, "error": "Job not found"}), 404
+    return jsonify({"ok": True, "job": job})
+
+
 # 入庫 API
 @app.route("/api/stock_in", methods=["POST"])
 def stock_in():
@@ -305,45 +2133,102 @@ def stock_in():
         if not data:
             return jsonify({"ok": False, "error": "缺少請求資料"}), 400
             
-        required_fields = ["料號系列", "料號", "數量"]
-        for field in required_fields:
-            if not data.get(field):
-                return jsonify({"ok": False, "error": f"缺少必填欄位: {field}"}), 400
-        
-        # 準備入庫記錄
-        from datetime import datetime
-        stock_record = {
-            "料號系列": data["料號系列"],
-            "料號": data["料號"],
-            "產品中文名稱": data.get("產品中文名稱", ""),
-            "數量": data["數量"],
-            "單價": data.get("單價"),
-            "入庫時間": datetime.now().isoformat(),
-            "操作類型": "入庫"
-        }
-        
-        # 插入到庫存記錄表
-        STOCK_RECORDS_COLLECTION_NAME = os.environ.get("STOCK_RECORDS_COLLECTION_NAME", "stock_records")
-        stock_records_collection = db[STOCK_RECORDS_COLLECTION_NAME]
-        
-        result = stock_records_collection.insert_one(stock_record)
+        if request.headers.get("Idempotency-Key"):
+            data.setdefault("idempotency_key", request.headers["Idempotency-Key"])
+        stock_record, error = build_stock_record(data)
+        if error:
+            return jsonify({"ok": False, "error": error}), 400
+
+        # 插入到庫存記錄表並更新庫存帳（重送相同冪等鍵時不會重複記帳）
+        status, detail = record_stock_movements([stock_record])[0]
+        if status == "failed":
+            return jsonify({"ok": False, "error": detail}), 500
         
         return jsonify({
             "ok": True, 
             "message": "入庫成功",
-            "record_id": str(result.inserted_id)
+            "record_id": str(detail)
         })
         
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
 
+# 批次庫存異動 API
+@app.route("/api/stock_movements", methods=["POST"])
+def stock_movements():
+    """
+    批次入庫 / 出庫，一次寫入多筆異動。
+    JSON: {"movements": [{料號系列, 料號, 數量, 操作類型 (入庫|出庫，預設入庫), idempotency_key, ...}]}
+    每筆各自檢查與回報結果；相同 idempotency_key 重送時回傳 duplicate，不會重複記帳。
+    """
+    try:
+        data = request.get_json(silent=True)
+        movements = data.get("movements") if isinstance(data, dict) else data
+        if not isinstance(movements, list) or not movements:
+            return jsonify({"ok": False, "error": "缺少 movements 清單"}), 400
+        if len(movements) > STOCK_MOVEMENTS_MAX:
+            return jsonify({"ok": False, "error": f"單次最多 {STOCK_MOVEMENTS_MAX} 筆"}), 400
+
+        results = [None] * len(movements)
+        records = []
+        positions = []
+        for i, item in enumerate(movements):
+            if not isinstance(item, dict):
+                results[i] = {"index": i, "ok": False, "error": "格式錯誤"}
+                continue
+            record, error = build_stock_record(item, item.get("操作類型") or "入庫")
+            if error:
+                results[i] = {"index": i, "ok": False, "error": error}
+                continue
+            records.append(record)
+            positions.append(i)
+
+        outcomes = record_stock_movements(records) if records else []
+        for i, (status, detail) in zip(positions, outcomes):
+            if status == "failed":
+                results[i] = {"index": i, "ok": False, "error": detail}
+            else:
+                results[i] = {"index": i, "ok": True, "status": status, "record_id": str(detail) if detail else None}
+
+        summary = {
+            "created": sum(1 for r in results if r.get("status") == "created"),
+            "duplicate": sum(1 for r in results if r.get("status") == "duplicate"),
+            "failed": sum(1 for r in results if not r["ok"]),
+        }
+        return jsonify({"ok": summary["failed"] == 0, **summary, "results": results})
+    except Exception as e:
+        return jsonify({"ok": False, "error": str(e)}), 500
+
+
+# 庫存帳查詢 API
+@app.route("/api/stock_balances", methods=["GET"])
+def get_stock_balances():
+    """
+    批次查詢目前在庫數量
+    Query param: numbers (料號，可重複或以逗號分隔；省略時回傳全部)
+    """
+    try:
+        numbers = [n for value in request.args.getlist("numbers") for n in value.split(",")]
+        keys = [key for key in (normalize_partno(n) for n in numbers) if key]
+        query = {"_id": {"$in": keys}} if numbers else {}
+        balances = {
+            doc["_id"]: {"料號系列": doc.get("料號系列"), "庫存": doc.get("庫存", 0)}
+            for doc in stock_balances_collection.find(query, {"料號系列": 1, "庫存": 1})
+        }
+        return jsonify({"ok": True, "balances": balances})
+    except Exception as e:
+        return jsonify({"ok": False, "error": str(e)}), 500
+
+
 # 撿貨資訊表搜尋 API
 @app.route("/api/search_pick", methods=["GET"])
+@cached_response
 def search_pick():
     """
-    以 MIC需求起日 為條件，分別搜尋三個資料庫，回傳指定欄位。
-    Query param: mic_start (MIC需求起日)
+    以 MIC需求起日 為條件搜尋三個資料庫，於伺服器端全域排序並分頁，回傳指定欄位。
+    Query params: mic_start / mic_end (MIC需求起日區間), sort_field, sort_order (asc|desc),
+    skip, limit (每頁筆數，預設 PICK_PAGE_SIZE)，format=columnar (欄位式回應)
     """
     mic_start = request.args.get("mic_start")
     mic_end = request.args.get("mic_end")
@@ -351,138 +2236,271 @@ def search_pick():
     sort_order = request.args.get("sort_order", "asc")
     if not mic_start or not mic_end:
         return jsonify({"ok": False, "error": "缺少 MIC需求起日區間 參數"}), 400
-    # 欄位
-    fields = ["MIC需求起日", "MIC需求訖日", "料號", "版本", "產品中文名稱", "數量", "單價", "PO單號", "庫存"]
-    result = {}
-    # 日期區間搜尋
-    from datetime import datetime
-    def parse_date(s):
-        for fmt in ["%Y-%m-%d", "%Y/%m/%d", "%Y-%m-%dT%H:%M:%S", "%Y/%m/%dT%H:%M:%S"]:
-            try:
-                return datetime.strptime(s, fmt)
-            except Exception:
-                continue
-        try:
-            return datetime.fromisoformat(s)
-        except Exception:
-            return None
-    start_dt = parse_date(mic_start)
-    end_dt = parse_date(mic_end)
-    pick_results = []
-    import sys
-    for name, coll in [
-        ("purchase_shipping", purchase_shipping_collection),
-        ("inventory_need", inventory_need_collection),
-        ("customer_need", customer_need_collection)
-    ]:
-        is_single_day = mic_start == mic_end
-        from datetime import timedelta
-        if is_single_day:
-            query = {"$or": []}
-            for fmt in [lambda s: s, lambda s: s.replace("-", "/"), lambda s: s.replace("/", "-")]:
-                start_str = fmt(mic_start)
-                query["$or"].append({"MIC需求起日": start_str})
-                query["$or"].append({"MIC需求起日": {"$regex": f"^{start_str}T"}})
-            if start_dt:
-                day_start = start_dt.replace(hour=0, minute=0, second=0, microsecond=0)
-                day_end = day_start + timedelta(days=1) - timedelta(microseconds=1)
-                query["$or"].append({"MIC需求起日": {"$gte": day_start, "$lte": day_end}})
-                query["$or"].append({"MIC需求起日": start_dt})
-        else:
-            from datetime import datetime, timedelta
-            start_date = None
-            end_date = None
-            for fmt in ["%Y-%m-%d", "%Y/%m/%d"]:
-                try:
-                    start_date = datetime.strptime(mic_start, fmt)
-                    end_date = datetime.strptime(mic_end, fmt)
-                    break
-                except Exception:
-                    continue
-            if not start_date or not end_date:
-                query = {"MIC需求起日": None}
-            else:
-                next_day = end_date + timedelta(days=1)
-                query = {
-                    "$or": [
-                        {"$expr": {
-                            "$and": [
-                                {"$gte": [{"$substr": ["$MIC需求起日", 0, 10]}, start_date.strftime("%Y-%m-%d")]},
-                                {"$lt": [{"$substr": ["$MIC需求起日", 0, 10]}, next_day.strftime("%Y-%m-%d")]} 
-                            ]
-                        }},
-                        {"MIC需求起日": {"$gte": start_date, "$lt": next_day}}
-                    ]
-                }
-        # Debug print
-        print(f"[DEBUG] Searching {name} with query: {query}", file=sys.stderr)
-        docs = list(coll.find(query, {f: 1 for f in fields}))
-        # 排序
-        reverse = sort_order == "desc"
-        if sort_field in fields:
-            docs.sort(key=lambda d: (d.get(sort_field) if d.get(sort_field) is not None else ''), reverse=reverse)
-        print(f"[DEBUG] Found {len(docs)} records in {name} for MIC需求起日 between {mic_start} and {mic_end}", file=sys.stderr)
-        import math
-        for d in docs:
-            d.pop("_id", None)
-            for date_field in ["MIC需求起日", "MIC需求訖日"]:
-                if date_field in d and isinstance(d[date_field], str):
-                    d[date_field] = d[date_field].split('T')[0]
-            for k, v in d.items():
-                if isinstance(v, float) and math.isnan(v):
-                    d[k] = None
-            pick_results.append(d)
-    # 取得所有料號
-    partnos = list({row.get("料號") for row in pick_results if row.get("料號")})
-    # 以料號搜尋所有資料庫，取得 產品中文名稱、單價、庫存
-    enrich_fields = ["產品中文名稱", "單價", "庫存"]
-    enrich_data = {}
-    search_collections = []
-    # 產品資料庫
-    PRODUCTS_COLLECTION_NAME = os.environ.get("PRODUCTS_COLLECTION_NAME", "products")
-    products_collection = db[PRODUCTS_COLLECTION_NAME]
-    search_collections.append(products_collection)
-    # 其他三個資料庫
-    search_collections.extend([purchase_shipping_collection, inventory_need_collection, customer_need_collection])
-    import math
-    for partno in partnos:
-        enrich_data[partno] = {}
-        for coll in search_collections:
-            for key in [partno, None]:
-                if key is None:
-                    try:
-                        partno_float = float(partno)
-                        keys_to_try = [partno_float, str(partno_float)]
-                    except Exception:
-                        keys_to_try = []
-                else:
-                    keys_to_try = [key]
-                for k in keys_to_try:
-                    doc = coll.find_one({"料號": k}, {f: 1 for f in enrich_fields})
-                    if doc:
-                        for f in enrich_fields:
-                            val = doc.get(f)
-                            if isinstance(val, float) and math.isnan(val):
-                                val = None
-                            if val is not None and f not in enrich_data[partno]:
-                                enrich_data[partno][f] = val
-                    if all(f in enrich_data[partno] for f in enrich_fields):
-                        break
-                if all(f in enrich_data[partno] for f in enrich_fields):
-                    break
-    # 合併 enrich_data 到 pick_results
-    for row in pick_results:
-        partno = row.get("料號")
-        if partno and partno in enrich_data:
-            for f in enrich_fields:
-                val = enrich_data[partno].get(f)
-                if isinstance(val, float) and math.isnan(val):
-                    val = None
-                if val is not None:
-                    row[f] = val
+    try:
+        skip = max(int(request.args.get("skip", "0")), 0)
+        limit = min(max(int(request.args.get("limit", PICK_PAGE_SIZE)), 1), PICK_MAX_LIMIT)
+    except ValueError:
+        return jsonify({"ok": False, "error": "skip / limit 必須為整數"}), 400
+    query = pick_date_query(mic_start, mic_end)
+    if query is None:
+        return jsonify({"ok": False, "error": "MIC需求起日區間 格式錯誤"}), 400
+    # 各資料庫的總筆數（以索引計數）與分頁資料並行查詢
+    count_futures = [submit_read(coll.count_documents, query) for coll in PICK_COLLECTIONS]
+    pick_results = find_pick_rows(query, sort_field, sort_order, skip, limit)
+    total = sum(future.result() for future in count_futures)
+    page = {
+        "ok": True,
+        "total": total,
+        "skip": skip,
+        "limit": limit,
+        "has_more": skip + len(pick_results) < total,
+    }
+    if request.args.get("format") == "columnar":
+        return fast_jsonify({**page, "format": "columnar", "data": {"pick": columnar(pick_results, PICK_FIELDS)}})
     # 分組回傳
-    result = {"pick": pick_results}
-    return jsonify({"ok": True, "data": result})
+    return jsonify({**page, "data": {"pick": pick_results}})
+
+
+# 出貨單產生 API
+@app.route("/api/shipping_slips", methods=["GET"])
+def shipping_slips():
+    """
+    依撿貨資料批次產生出貨單，每個 PO單號 一張。
+    Query params: mic_start / mic_end (MIC需求起日區間) 或 po (PO單號，可重複或以逗號分隔)，
+    ship_date (出貨日期，預設今天)，format=xlsx (單一活頁簿，每張一個 sheet，預設) | zip (每張一個檔案)
+    """
+    mic_start = request.args.get("mic_start")
+    mic_end = request.args.get("mic_end")
+    po_numbers = [p.strip() for value in request.args.getlist("po") for p in value.split(",") if p.strip()]
+    fmt = request.args.get("format", "xlsx")
+    if fmt not in ("xlsx", "zip"):
+        return jsonify({"ok": False, "error": "format 必須為 xlsx 或 zip"}), 400
+    if not po_numbers and not (mic_start and mic_end):
+        return jsonify({"ok": False, "error": "缺少 MIC需求起日區間 或 PO單號 參數"}), 400
+
+    query = {}
+    if mic_start and mic_end:
+        query = pick_date_query(mic_start, mic_end)
+        if query is None:
+            return jsonify({"ok": False, "error": "MIC需求起日區間 格式錯誤"}), 400
+    if po_numbers:
+        query["PO單號"] = {"$in": po_numbers}
+    ship_date = parse_date(request.args.get("ship_date")) or dt.datetime.now()
+
+    try:
+        groups = group_pick_rows_by_po(find_pick_rows(query, "MIC需求起日"))
+        if not groups:
+            return jsonify({"ok": False, "error": "查無撿貨資料"}), 404
+        ship_date = ship_date.strftime("%Y-%m-%d")
+        filename = f"shipping_slips_{dt.datetime.now():%Y%m%d%H%M%S}.{fmt}"
+        if fmt == "zip":
+            resp = Response(stream_slips_zip(groups, ship_date), mimetype="application/zip")
+        else:
+            resp = stream_slips_workbook(groups, ship_date)
+        resp.headers["Content-Disposition"] = f"attachment; filename={filename}"
+        return resp
+    except Exception as e:
+        return jsonify({"ok": False, "error": str(e)}), 500
+
+
+# 快取統計 API
+@app.route("/api/cache_stats", methods=["GET"])
+def cache_stats():
+    """
+    回傳讀取 API 快取的命中 / 未命中次數與目前大小，用於調整 CACHE_MAXSIZE 與 CACHE_TTL。
+    """
+    return jsonify({"ok": True, "cache": response_cache.stats()})
+
+
+# Prometheus 指標
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    以 Prometheus 文字格式輸出指標；設定 PROMETHEUS_MULTIPROC_DIR 時彙總所有 gunicorn worker 與匯入 process。
+    """
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+# 一次性遷移：替既有資料補上正規化料號欄位
+@app.cli.command("backfill-partno")
+def backfill_partno():
+    """為既有文件補上 _partno 欄位並建立索引。"""
+    ensure_indexes()
+    for coll in PARTNO_COLLECTIONS:
+        updated = 0
+        ops = []
+        cursor = coll.find({PARTNO_KEY: {"$exists": False}, "料號": {"$exists": True}}, {"料號": 1})
+        for doc in cursor:
+            ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {PARTNO_KEY: normalize_partno(doc["料號"])}}))
+            if len(ops) >= IMPORT_CHUNK_SIZE:
+                updated += coll.bulk_write(ops, ordered=False).modified_count
+                ops = []
+        if ops:
+            updated += coll.bulk_write(ops, ordered=False).modified_count
+        print(f"{coll.name}: {updated} documents updated")
+    invalidate_cache()
+
+
+# 一次性遷移：將既有資料的日期字串轉為 BSON 日期
+@app.cli.command("backfill-dates")
+def backfill_dates():
+    """將 MIC需求起日 / MIC需求訖日 的字串或數字值轉為日期，原始值保留於 _raw。"""
+    ensure_indexes()
+    for coll in PICK_COLLECTIONS:
+        updated = 0
+        ops = []
+        query = {"$or": [{field: {"$exists": True, "$not": {"$type": "date"}}} for field in DATE_FIELDS]}
+        for doc in coll.find(query, {field: 1 for field in DATE_FIELDS}):
+            update = {}
+            for field in DATE_FIELDS:
+                raw = doc.get(field)
+                parsed = parse_date(raw)
+                if parsed is not None and parsed is not raw:
+                    update[field] = parsed
+                    update[f"{RAW_FIELD}.{field}"] = raw
+            if update:
+                ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": update}))
+            if len(ops) >= IMPORT_CHUNK_SIZE:
+                updated += coll.bulk_write(ops, ordered=False).modified_count
+                ops = []
+        if ops:
+            updated += coll.bulk_write(ops, ordered=False).modified_count
+        print(f"{coll.name}: {updated} documents updated")
+    invalidate_cache()
+
+
+def normalize_stored(doc, record):
+    """比對既有文件與依 schema 轉換後的 record，回傳需要 $set 的欄位（沒有差異時為空 dict）。"""
+    update = {}
+    for name, value in record.items():
+        if name in (PARTNO_KEY, RAW_FIELD):
+            continue
+        old = doc.get(name)
+        if type(old) is not type(value) or old != value:
+            update[name] = value
+            if name in record.get(RAW_FIELD, {}):
+                update[f"{RAW_FIELD}.{name}"] = record[RAW_FIELD][name]
+    if PARTNO_KEY in record and doc.get(PARTNO_KEY) != record[PARTNO_KEY]:
+        update[PARTNO_KEY] = record[PARTNO_KEY]
+    if update and ROW_HASH in doc:
+        content = {k: v for k, v in {**doc, **update}.items() if not k.startswith("_")}
+        update[ROW_HASH] = _row_digest(content)
+    return update
+
+
+# 一次性遷移：依 COLUMN_SCHEMAS 轉換既有資料的欄位型別
+@app.cli.command("normalize-types")
+def normalize_types():
+    """依各資料庫的欄位 schema 轉換既有文件（日期、數值、文字），NaN 轉為 None，並重算 _partno 與 _row_hash。"""
+    ensure_indexes()
+    partnos = set()
+    for coll in PICK_COLLECTIONS:
+        schema = column_schema(coll)
+        updated = 0
+        cursor = coll.find({}, {RAW_FIELD: 0})
+        while True:
+            docs = [doc for _, doc in zip(range(IMPORT_CHUNK_SIZE), cursor)]
+            if not docs:
+                break
+            fields = list(dict.fromkeys(k for doc in docs for k in doc if not k.startswith("_")))
+            rows = [tuple(doc.get(k) for k in fields) for doc in docs]
+            ops = []
+            for doc, record in zip(docs, normalize_rows(fields, rows, schema)):
+                # 只比對文件本身有的欄位，其他文件才有的欄位不補上
+                record = {k: v for k, v in record.items() if k in doc or k in (PARTNO_KEY, RAW_FIELD)}
+                update = normalize_stored(doc, record)
+                if update:
+                    ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": update}))
+                    partnos.update({doc.get(PARTNO_KEY), update.get(PARTNO_KEY, doc.get(PARTNO_KEY))})
+            if ops:
+                updated += coll.bulk_write(ops, ordered=False).modified_count
+        print(f"{coll.name}: {updated} documents updated")
+    partnos.discard(None)
+    print(f"{CATALOG_COLLECTION_NAME}: {refresh_catalog(partnos)} part numbers refreshed")
+    invalidate_cache()
+
+
+# 完整重建料號目錄
+@app.cli.command("rebuild-catalog")
+def rebuild_catalog():
+    """依所有來源資料庫重建 product_catalog。"""
+    ensure_indexes()
+    keys = set()
+    for coll in CATALOG_SOURCES:
+        for doc in coll.aggregate([{"$group": {"_id": f"${PARTNO_KEY}"}}]):
+            keys.add(doc["_id"])
+    keys.update(doc["_id"] for doc in catalog_collection.find({}, {"_id": 1}))
+    print(f"{CATALOG_COLLECTION_NAME}: {refresh_catalog(keys)} part numbers refreshed")
+    invalidate_cache()
+
+
+# 以 stock_records 重新計算庫存帳
+@app.cli.command("rebuild-balances")
+def rebuild_balances():
+    """
+    依 stock_records 全部異動重算 stock_balances，只寫入不一致的料號。
+    舊資料的 數量 可能是字串（早期 /api/stock_in 未檢查），可轉換的字串照常計算，
+    無法轉換的以 0 計並列出筆數，不會讓整個 aggregation 失敗。
+    """
+    branches = [
+        {"case": {"$eq": ["$操作類型", kind]}, "then": {"$multiply": [sign, "$_qty"]}}
+        for kind, sign in STOCK_MOVEMENT_SIGNS.items()
+    ]
+    pipeline = [
+        {"$match": {PARTNO_KEY: {"$ne": None}}},
+        {"$set": {"_qty": {"$switch": {
+            "branches": [
+                {"case": {"$isNumber": "$數量"}, "then": "$數量"},
+                {"case": {"$eq": [{"$type": "$數量"}, "string"]}, "then": {"$convert": {
+                    "input": {"$trim": {"input": "$數量"}}, "to": "double", "onError": None,
+                }}},
+            ],
+            "default": None,
+        }}}},
+        {"$group": {
+            "_id": f"${PARTNO_KEY}",
+            "料號": {"$last": "$料號"},
+            "料號系列": {"$last": "$料號系列"},
+            "庫存": {"$sum": {"$switch": {"branches": branches, "default": 0}}},
+            "invalid": {"$sum": {"$cond": [{"$eq": ["$_qty", None]}, 1, 0]}},
+        }},
+    ]
+    expected = {}
+    invalid = {}
+    for doc in stock_records_collection.aggregate(pipeline):
+        count = doc.pop("invalid")
+        if count:
+            invalid[doc["_id"]] = count
+        doc["庫存"] = to_number(doc["庫存"]) or 0
+        expected[doc["_id"]] = doc
+    if invalid:
+        sample = ", ".join(f"{key} ({count})" for key, count in list(invalid.items())[:20])
+        print(f"{STOCK_RECORDS_COLLECTION_NAME}: {sum(invalid.values())} records with non-numeric 數量 counted as 0: {sample}")
+    now = dt.datetime.now(dt.timezone.utc)
+    ops, corrected = [], []
+    for doc in stock_balances_collection.find({}, {"庫存": 1}):
+        target = expected.pop(doc["_id"], None)
+        if target is None:
+            ops.append(DeleteOne({"_id": doc["_id"]}))
+        elif target["庫存"] != doc.get("庫存"):
+            ops.append(ReplaceOne({"_id": doc["_id"]}, {**target, "updated_at": now}))
+        else:
+            continue
+        corrected.append(doc["_id"])
+    for key, target in expected.items():
+        ops.append(ReplaceOne({"_id": key}, {**target, "updated_at": now}, upsert=True))
+        corrected.append(key)
+    if ops:
+        stock_balances_collection.bulk_write(ops, ordered=False)
+    print(f"{STOCK_BALANCES_COLLECTION_NAME}: {len(ops)} part numbers corrected")
+    # 目錄的庫存來自庫存帳，一併更新被修正的料號
+    refresh_catalog(corrected)
+    invalidate_cache()
 
 
 # Static files (optional)
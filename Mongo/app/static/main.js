@@ -1,9 +1,10 @@
+// Shared by index.html (loaded before its inline script); element bindings below are skipped on pages without them
 async function postForm(url, formData) {
   const resp = await fetch(url, { method: "POST", body: formData });
   return resp.json();
 }
 
-document.getElementById("upload-form").addEventListener("submit", async (e) => {
+document.getElementById("upload-form")?.addEventListener("submit", async (e) => {
   e.preventDefault();
   const input = document.getElementById("file-input");
   if (!input.files || input.files.length === 0) {
@@ -29,33 +30,68 @@ document.getElementById("upload-form").addEventListener("submit", async (e) => {
   }
 });
 
-document.getElementById("list-btn").addEventListener("click", async () => {
-  const resp = await fetch("/api/items");
+// Columnar responses (format=columnar) list column names once: {columns, values: [one array per column], length}
+function columnarRows(table) {
+  const rows = new Array(table.length);
+  for (let i = 0; i < table.length; i++) {
+    const row = {};
+    table.columns.forEach((c, j) => { row[c] = table.values[j][i]; });
+    rows[i] = row;
+  }
+  return rows;
+}
+
+// Keyset pagination: each page carries a "next" token for the following page
+let itemsNext = null;
+let itemsKeys = null;
+let itemsShown = 0;
+
+function renderItemRows(items) {
+  let html = "";
+  items.forEach(item => {
+    html += "<tr>";
+    itemsKeys.forEach(k => html += `<td>${item[k] === null || item[k] === undefined ? "" : item[k]}</td>`);
+    html += "</tr>";
+  });
+  return html;
+}
+
+async function loadItems(append) {
+  const params = new URLSearchParams({ format: "columnar" });
+  if (append && itemsNext) params.set("after", itemsNext);
+  const resp = await fetch(`/api/items?${params}`);
   const data = await resp.json();
+  const items = columnarRows(data.items);
   const container = document.getElementById("items-table");
   const countDiv = document.getElementById("items-count");
-  countDiv.textContent = `共 ${data.count} 筆（最多顯示 1000）`;
+  itemsNext = data.next;
 
-  if (!data.items || data.items.length === 0) {
-    container.innerHTML = "<p>目前沒有資料</p>";
-    return;
+  if (!append) {
+    itemsShown = 0;
+    if (items.length === 0) {
+      container.innerHTML = "<p>目前沒有資料</p>";
+      countDiv.textContent = "共 0 筆";
+      return;
+    }
+    // Build a table dynamically with the columns of the first page
+    itemsKeys = data.items.columns;
+    let html = "<table><thead><tr>";
+    itemsKeys.forEach(k => html += `<th>${k}</th>`);
+    html += "</tr></thead><tbody></tbody></table>";
+    html += '<button id="items-more-btn" type="button">載入更多</button>';
+    container.innerHTML = html;
+    document.getElementById("items-more-btn").addEventListener("click", () => loadItems(true));
   }
 
-  // Build a table dynamically with keys from first item
-  const keys = Object.keys(data.items[0]);
-  let html = "<table><thead><tr>";
-  keys.forEach(k => html += `<th>${k}</th>`);
-  html += "</tr></thead><tbody>";
-  data.items.forEach(item => {
-    html += "<tr>";
-    keys.forEach(k => html += `<td>${item[k] === null || item[k] === undefined ? "" : item[k]}</td>`);
-    html += "</tr>";
-  });
-  html += "</tbody></table>";
-  container.innerHTML = html;
-});
+  container.querySelector("tbody").insertAdjacentHTML("beforeend", renderItemRows(items));
+  itemsShown += data.count;
+  countDiv.textContent = `已顯示 ${itemsShown} 筆${itemsNext ? "（尚有更多）" : ""}`;
+  document.getElementById("items-more-btn").style.display = itemsNext ? "" : "none";
+}
+
+document.getElementById("list-btn")?.addEventListener("click", () => loadItems(false));
 
-document.getElementById("clear-btn").addEventListener("click", async () => {
+document.getElementById("clear-btn")?.addEventListener("click", async () => {
   if (!confirm("這會刪除整個 collection 的所有資料，確定要執行嗎？")) return;
   const resultDiv = document.getElementById("clear-result");
   resultDiv.textContent = "Clearing...";
@@ -0,0 +1,147 @@
+"""
+產生效能測試用的合成 Excel 活頁簿，欄位版面與實際檔案相同：
+- purchase_shipping：採購與出貨表.xlsx（訂購日期、系列、D W G、數量、單 價、小計、採購單號、預計交期、出貨單據編號）
+- inventory_need：庫存與採購需求表.xlsx（系列、料號、版本、產品中文名稱、單價、剩餘採購數量、庫存）
+- customer_need：客戶需求表（撿貨資訊表使用的 MIC需求起日 / MIC需求訖日、料號、版本、PO單號 ...）
+
+以 openpyxl write-only 模式逐列寫出，1M 列也只需固定記憶體；同一 seed 產生的內容完全相同。
+
+    python bench/generate_workbooks.py --rows 100000 --out bench/data
+"""
+import argparse
+import datetime as dt
+import os
+import random
+import time
+
+from openpyxl import Workbook
+
+HEADERS = {
+    "purchase_shipping": ["訂購日期", "系列", "D W G", "數量", "單 價", "小計", "採購單號", "預計交期", "出貨單據編號"],
+    "inventory_need": ["系列", "料號", "版本", "產品中文名稱", "單價", "剩餘採購數量", "庫存"],
+    "customer_need": ["PO單號", "料號", "版本", "產品中文名稱", "數量", "單價", "MIC需求起日", "MIC需求訖日"],
+}
+SHEET_TITLES = {"purchase_shipping": "FS", "inventory_need": "庫存表", "customer_need": "客戶需求"}
+KINDS = list(HEADERS)
+
+SERIES = ["600系列", "700系列", "800系列", "900系列", "DZ", "DX"]
+NAMES = ["小薄片", "中薄片", "大薄片", "墊片", "固定座", "連接桿", "外殼", "底座"]
+VERSIONS = ["A", "B", "C"]
+# MIC 需求日期分布在這一年內，search_pick 的日期區間測試以此為範圍
+DATE_START = dt.datetime(2025, 1, 1)
+DATE_DAYS = 365
+
+
+class PartCatalog:
+    """料號母體：約每 50 列一個料號，系列、品名、單價固定，讓目錄與下拉選單有真實的基數。"""
+
+    def __init__(self, rows, rng):
+        count = max(200, rows // 50)
+        self.parts = [
+            (250000 + i, rng.choice(SERIES), rng.choice(NAMES), rng.randrange(50, 3000, 5))
+            for i in range(count)
+        ]
+
+    def pick(self, rng):
+        return rng.choice(self.parts)
+
+
+def _yyyymmdd(day):
+    return int(day.strftime("%Y%m%d"))
+
+
+def _purchase_shipping_rows(rows, rng, parts):
+    for i in range(rows):
+        partno, series, _, price = parts.pick(rng)
+        ordered = DATE_START + dt.timedelta(days=rng.randrange(DATE_DAYS))
+        delivery = ordered + dt.timedelta(days=rng.randrange(30, 90))
+        qty = rng.randrange(1, 200)
+        po = f"TPOM7{ordered:%y%m}{rng.randrange(100000):05d} Rev.：{rng.randrange(3):02d}"
+        shipped = f"{delivery:%Y%m%d}-{rng.randrange(1, 10):02d}" if rng.random() < 0.4 else None
+        row_no = i + 2
+        yield [
+            _yyyymmdd(ordered), series, f"D5ZN{partno} 版本{rng.randrange(3)}", qty, price,
+            f"=SUM(D{row_no}*E{row_no})", po, _yyyymmdd(delivery), shipped,
+        ]
+
+
+def _inventory_need_rows(rows, rng, parts):
+    for i in range(rows):
+        partno, series, name, price = parts.parts[i % len(parts.parts)]
+        yield [series, partno, VERSIONS[(i // len(parts.parts)) % len(VERSIONS)], name, price,
+               rng.randrange(0, 1000), rng.randrange(0, 500)]
+
+
+def _customer_need_rows(rows, rng, parts):
+    for _ in range(rows):
+        partno, _, name, price = parts.pick(rng)
+        start = DATE_START + dt.timedelta(days=rng.randrange(DATE_DAYS))
+        end = start + dt.timedelta(days=rng.randrange(0, 31))
+        yield [f"PO{rng.randrange(10 ** 7):07d}", partno, rng.choice(VERSIONS), name,
+               rng.randrange(1, 500), price, start, end]
+
+
+ROW_GENERATORS = {
+    "purchase_shipping": _purchase_shipping_rows,
+    "inventory_need": _inventory_need_rows,
+    "customer_need": _customer_need_rows,
+}
+
+
+def generate(kind, rows, path, seed=0):
+    """產生單一活頁簿並回傳 path。"""
+    rng = random.Random(f"{kind}:{seed}")
+    parts = PartCatalog(rows, random.Random(seed))
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(SHEET_TITLES[kind])
+    ws.append(HEADERS[kind])
+    for row in ROW_GENERATORS[kind](rows, rng, parts):
+        ws.append(row)
+    wb.save(path)
+    return path
+
+
+def stock_in_movements(rows, seed=0):
+    """
+    每個料號一筆入庫異動（/api/stock_movements 的格式）。
+    料號系列只來自庫存異動與產品主檔，下拉選單的測試需要先寫入這些資料。
+    """
+    rng = random.Random(f"stock:{seed}")
+    return [
+        {"料號系列": series, "料號": partno, "產品中文名稱": name, "單價": price,
+         "數量": rng.randrange(1, 100), "idempotency_key": f"bench-{seed}-{partno}"}
+        for partno, series, name, price in PartCatalog(rows, random.Random(seed)).parts
+    ]
+
+
+def workbook_path(out_dir, kind, rows, seed=0):
+    return os.path.join(out_dir, f"{kind}_{rows}_s{seed}.xlsx")
+
+
+def ensure_workbooks(out_dir, rows, seed=0, kinds=None):
+    """產生（或沿用已存在的）各類活頁簿，回傳 {kind: path}。"""
+    os.makedirs(out_dir, exist_ok=True)
+    paths = {}
+    for kind in kinds or KINDS:
+        path = workbook_path(out_dir, kind, rows, seed)
+        if not os.path.exists(path):
+            started = time.perf_counter()
+            generate(kind, rows, path, seed)
+            print(f"generated {path} ({rows} rows, {time.perf_counter() - started:.1f}s)")
+        paths[kind] = path
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="產生合成的採購與出貨表 / 庫存與採購需求表 / 客戶需求表")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000], help="每個檔案的列數，可指定多個（10000 ~ 1000000）")
+    parser.add_argument("--kinds", nargs="+", choices=KINDS, default=KINDS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=os.path.join(os.path.dirname(__file__), "data"))
+    args = parser.parse_args()
+    for rows in args.rows:
+        ensure_workbooks(args.out, rows, args.seed, args.kinds)
+
+
+if __name__ == "__main__":
+    main()
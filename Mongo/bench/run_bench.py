@@ -0,0 +1,285 @@
+"""
+效能測試驅動程式：在本機 mongod 上量測
+- upload：三個上傳 API 的匯入吞吐量（rows/sec）
+- search_pick：不同日期區間寬度（1 ~ 365 天）的查詢延遲
+- stock_movements：批次入庫 API 的吞吐量（同時寫入下拉選單所需的料號系列）
+- dropdown：product_series / product_numbers / product_info 的延遲（冷快取與熱快取）
+- explain：撿貨日期查詢是否走索引
+
+Flask app 以 test_client 在同一 process 內執行（不經過 HTTP），連線到 --mongo-uri 的 --db 資料庫；
+該資料庫會在開始時整個刪除，因此名稱必須包含 "bench"。結果輸出為 JSON，可用 --compare 與前次結果比較。
+--app-dir 可指向其他 commit 的 app/（例如 git worktree），受測 app 沒有的功能會略過並記在 skipped。
+
+    python bench/run_bench.py --rows 100000 --out bench/results/latest.json --compare bench/baseline.json
+"""
+import argparse
+import datetime as dt
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from generate_workbooks import DATE_DAYS, DATE_START, ensure_workbooks, stock_in_movements  # noqa: E402
+
+UPLOAD_ENDPOINTS = {
+    "purchase_shipping": "/api/upload_purchase_shipping",
+    "inventory_need": "/api/upload_inventory_need",
+    "customer_need": "/api/upload_customer_need",
+}
+PICK_WIDTHS = [1, 7, 30, 90, 365]
+
+
+def summarize(samples_ms):
+    """延遲樣本（毫秒）的統計摘要。"""
+    ordered = sorted(samples_ms)
+
+    def pct(p):
+        return round(ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))], 2)
+
+    return {
+        "n": len(ordered),
+        "mean_ms": round(statistics.fmean(ordered), 2),
+        "p50_ms": pct(50),
+        "p95_ms": pct(95),
+        "p99_ms": pct(99),
+        "min_ms": round(ordered[0], 2),
+        "max_ms": round(ordered[-1], 2),
+    }
+
+
+def has_route(appmod, rule):
+    return any(r.rule == rule for r in appmod.app.url_map.iter_rules())
+
+
+def clear_response_cache(appmod):
+    # 較早的版本沒有回應快取
+    cache = getattr(appmod, "response_cache", None)
+    if cache is not None:
+        cache.clear()
+
+
+def timed_get(client, url, params=None):
+    started = time.perf_counter()
+    resp = client.get(url, query_string=params)
+    elapsed = (time.perf_counter() - started) * 1000
+    if resp.status_code != 200:
+        raise RuntimeError(f"GET {url} -> {resp.status_code}: {resp.get_data(as_text=True)[:200]}")
+    return elapsed, resp
+
+
+def bench_uploads(appmod, client, paths):
+    results = {}
+    for kind, url in UPLOAD_ENDPOINTS.items():
+        with open(paths[kind], "rb") as f:
+            started = time.perf_counter()
+            resp = client.post(url, data={"file": (f, os.path.basename(paths[kind]))},
+                               content_type="multipart/form-data")
+            wall = time.perf_counter() - started
+        stats = resp.get_json()
+        if resp.status_code != 200 or not stats.get("ok"):
+            raise RuntimeError(f"upload {kind} failed: {stats}")
+        # 沒有分批匯入的版本不回傳 chunks，只記錄總耗時
+        chunks = stats.get("chunks")
+        results[kind] = {
+            "rows": stats["inserted"],
+            "wall_ms": round(wall * 1000, 1),
+            "rows_per_sec": round(stats["inserted"] / wall, 1) if wall else None,
+            "parse_ms": round(sum(c["parse_ms"] for c in chunks), 1) if chunks else None,
+            "insert_ms": round(sum(c["insert_ms"] for c in chunks), 1) if chunks else None,
+        }
+        print(f"upload {kind}: {results[kind]['rows']} rows, {results[kind]['rows_per_sec']} rows/s")
+    return results
+
+
+def bench_stock_movements(appmod, client, movements, batch_size):
+    # 沒有批次 API 的版本逐筆呼叫 /api/stock_in
+    if has_route(appmod, "/api/stock_movements"):
+        url, batches = "/api/stock_movements", [
+            {"movements": movements[i:i + batch_size]} for i in range(0, len(movements), batch_size)
+        ]
+    else:
+        url, batch_size, batches = "/api/stock_in", 1, movements
+    started = time.perf_counter()
+    for body in batches:
+        resp = client.post(url, json=body)
+        if resp.status_code != 200 or not resp.get_json().get("ok"):
+            raise RuntimeError(f"{url} failed: {resp.get_data(as_text=True)[:200]}")
+    wall = time.perf_counter() - started
+    result = {"endpoint": url, "rows": len(movements), "batch_size": batch_size, "wall_ms": round(wall * 1000, 1),
+              "rows_per_sec": round(len(movements) / wall, 1) if wall else None}
+    print(f"stock_movements: {result['rows']} rows, {result['rows_per_sec']} rows/s")
+    return result
+
+
+def bench_search_pick(appmod, client, repeat, rng):
+    results = {}
+    variants = [(f"{w}d", w, "MIC需求起日") for w in PICK_WIDTHS] + [("30d_sort_partno", 30, "料號")]
+    for name, width, sort_field in variants:
+        samples, totals = [], []
+        for _ in range(repeat):
+            start = DATE_START + dt.timedelta(days=rng.randrange(max(1, DATE_DAYS - width + 1)))
+            end = start + dt.timedelta(days=width - 1)
+            params = {"mic_start": f"{start:%Y-%m-%d}", "mic_end": f"{end:%Y-%m-%d}", "sort_field": sort_field}
+            clear_response_cache(appmod)
+            elapsed, resp = timed_get(client, "/api/search_pick", params)
+            samples.append(elapsed)
+            body = resp.get_json()
+            # 沒有分頁的版本不回傳 total，以回傳的列數計算
+            totals.append(body["total"] if "total" in body else len(body.get("data", {}).get("pick", [])))
+        results[name] = {**summarize(samples), "mean_total_rows": round(statistics.fmean(totals), 1)}
+        print(f"search_pick {name}: p50 {results[name]['p50_ms']} ms, {results[name]['mean_total_rows']} rows")
+    return results
+
+
+def bench_dropdowns(appmod, client, repeat, rng):
+    series = client.get("/api/product_series").get_json().get("series", [])
+    numbers = []
+    for s in series:
+        numbers.extend(client.get("/api/product_numbers", query_string={"series": s}).get_json().get("numbers", []))
+    requests = {
+        "product_series": lambda: ("/api/product_series", None),
+        "product_numbers": lambda: ("/api/product_numbers", {"series": rng.choice(series)}),
+        "product_info": lambda: ("/api/product_info", {"number": rng.choice(numbers)}),
+    }
+    results = {}
+    for name, make_request in requests.items():
+        if name != "product_series" and not (series and numbers):
+            continue
+        cold, warm = [], []
+        for _ in range(repeat):
+            url, params = make_request()
+            clear_response_cache(appmod)
+            cold.append(timed_get(client, url, params)[0])
+            warm.append(timed_get(client, url, params)[0])
+        results[name] = {"cold": summarize(cold), "warm": summarize(warm)}
+        print(f"{name}: cold p50 {results[name]['cold']['p50_ms']} ms, warm p50 {results[name]['warm']['p50_ms']} ms")
+    return results
+
+
+def explain_pick_query(appmod):
+    """撿貨日期查詢在各資料庫的 winning plan 是否為 IXSCAN。"""
+    end = DATE_START + dt.timedelta(days=29)
+    query = appmod.pick_date_query(f"{DATE_START:%Y-%m-%d}", f"{end:%Y-%m-%d}")
+    plans = {}
+    for coll in appmod.PICK_COLLECTIONS:
+        plan = coll.find(query).explain().get("queryPlanner", {}).get("winningPlan", {})
+        plans[coll.name] = "IXSCAN" if "IXSCAN" in json.dumps(plan) else "COLLSCAN"
+    return plans
+
+
+def run_metadata(appmod, args):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=args.app_dir,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    import pymongo
+    return {
+        "timestamp": dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds"),
+        "commit": commit,
+        "rows": args.rows,
+        "seed": args.seed,
+        "repeat": args.repeat,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "pymongo": pymongo.version,
+        "mongod": appmod.client.server_info().get("version"),
+        "app_dir": os.path.abspath(args.app_dir),
+        "import_chunk_size": getattr(appmod, "IMPORT_CHUNK_SIZE", None),
+    }
+
+
+def _flatten(results, prefix=""):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{prefix}{key}.")
+        elif key in ("p50_ms", "p95_ms", "rows_per_sec"):
+            yield f"{prefix}{key}", value
+
+
+def compare(current, baseline, max_regression):
+    """列出與 baseline 的差異；延遲變慢或吞吐量下降超過 max_regression% 時回傳 False。"""
+    base = dict(_flatten(baseline["results"]))
+    ok = True
+    print(f"\ncompare with baseline {baseline['meta'].get('commit')} ({baseline['meta'].get('timestamp')})")
+    for key, value in _flatten(current["results"]):
+        if key not in base or not base[key] or value is None:
+            continue
+        change = (value - base[key]) / base[key] * 100
+        worse = -change if key.endswith("rows_per_sec") else change
+        flag = ""
+        if max_regression is not None and worse > max_regression:
+            flag = "  REGRESSION"
+            ok = False
+        print(f"{key:55s} {base[key]:>12} -> {value:>12}  {change:+6.1f}%{flag}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="匯入 / 撿貨查詢 / 下拉選單效能測試")
+    parser.add_argument("--rows", type=int, default=10000, help="每個合成檔案的列數（10000 ~ 1000000）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=20, help="每個查詢情境的重複次數")
+    parser.add_argument("--mongo-uri", default=os.environ.get("BENCH_MONGO_URI", "mongodb://localhost:27017/"))
+    parser.add_argument("--db", default="bench", help="測試用資料庫（開始時會被刪除，名稱須包含 bench）")
+    parser.add_argument("--data-dir", default=os.path.join(BENCH_DIR, "data"))
+    parser.add_argument("--app-dir", default=os.path.join(BENCH_DIR, "..", "app"),
+                        help="受測 app 的目錄（可指向其他 commit 的 git worktree）")
+    parser.add_argument("--out", default=os.path.join(BENCH_DIR, "results", "latest.json"))
+    parser.add_argument("--compare", help="與此 JSON 結果比較")
+    parser.add_argument("--max-regression", type=float, help="超過此百分比的退步時以 exit code 1 結束")
+    args = parser.parse_args()
+    if "bench" not in args.db:
+        parser.error("--db 名稱必須包含 bench，避免刪除正式資料")
+    # 在跑完整個測試前就檢查，避免最後才因找不到基準而失敗
+    if args.compare and not os.path.isfile(args.compare):
+        parser.error(f"找不到比較基準 {args.compare}；請先在同一台機器上以 --out {args.compare} 產生基準")
+
+    paths = ensure_workbooks(args.data_dir, args.rows, args.seed)
+
+    # app 在 import 時讀取設定，須先設定環境變數
+    os.environ["MONGO_URI"] = args.mongo_uri
+    os.environ["DB_NAME"] = args.db
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    sys.path.insert(0, args.app_dir)
+    import app as appmod
+
+    appmod.client.drop_database(args.db)
+    client = appmod.app.test_client()
+    rng = random.Random(args.seed)
+    current = {"meta": run_metadata(appmod, args), "results": {}}
+    current["results"]["upload"] = bench_uploads(appmod, client, paths)
+    current["results"]["stock_movements"] = bench_stock_movements(
+        appmod, client, stock_in_movements(args.rows, args.seed), getattr(appmod, "STOCK_MOVEMENTS_MAX", 1000))
+    current["results"]["search_pick"] = bench_search_pick(appmod, client, args.repeat, rng)
+    current["results"]["dropdown"] = bench_dropdowns(appmod, client, args.repeat, rng)
+    # 料號系列來自入庫紀錄；較早的版本不從 stock_records 讀取料號系列，下拉選單只測得到 product_series
+    current["skipped"] = [f"dropdown.{name}" for name in ("product_numbers", "product_info")
+                          if name not in current["results"]["dropdown"]]
+    if hasattr(appmod, "pick_date_query"):
+        current["explain"] = explain_pick_query(appmod)
+        print(f"pick date query plans: {current['explain']}")
+    else:
+        current["skipped"].append("explain")
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(current, f, ensure_ascii=False, indent=2)
+    print(f"results written to {args.out}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            if not compare(current, json.load(f), args.max_regression):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+撿貨日期查詢（MIC需求起日 的 $gte/$lt 範圍）在三個撿貨資料庫都必須走索引。
+需要可連線的 mongod（TEST_MONGO_URI，預設 mongodb://localhost:27017/），連不上時略過。
+
+    python -m pytest tests
+"""
+import datetime as dt
+import json
+import os
+import sys
+
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+TEST_MONGO_URI = os.environ.get("TEST_MONGO_URI", "mongodb://localhost:27017/")
+TEST_DB_NAME = "pick_query_test"
+
+
+def _mongod_reachable():
+    try:
+        MongoClient(TEST_MONGO_URI, serverSelectionTimeoutMS=1000).admin.command("ping")
+        return True
+    except PyMongoError:
+        return False
+
+
+pytestmark = pytest.mark.skipif(not _mongod_reachable(), reason=f"mongod 無法連線：{TEST_MONGO_URI}")
+
+
+@pytest.fixture(scope="module")
+def appmod():
+    # app 在 import 時讀取設定，須先設定環境變數
+    os.environ["MONGO_URI"] = TEST_MONGO_URI
+    os.environ["DB_NAME"] = TEST_DB_NAME
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+    import app as appmod
+
+    appmod.client.drop_database(TEST_DB_NAME)
+    appmod.ensure_indexes()
+    start = dt.datetime(2025, 1, 1)
+    for coll in appmod.PICK_COLLECTIONS:
+        coll.insert_many([
+            {"MIC需求起日": start + dt.timedelta(days=i), "MIC需求訖日": start + dt.timedelta(days=i + 7), "料號": 250000 + i}
+            for i in range(200)
+        ])
+    yield appmod
+    appmod.client.drop_database(TEST_DB_NAME)
+
+
+@pytest.mark.parametrize("mic_start, mic_end", [("2025-01-01", "2025-01-01"), ("2025-02-01", "2025/03/02")])
+def test_pick_date_query_uses_index(appmod, mic_start, mic_end):
+    query = appmod.pick_date_query(mic_start, mic_end)
+    for coll in appmod.PICK_COLLECTIONS:
+        plan = coll.find(query).explain()["queryPlanner"]["winningPlan"]
+        assert "IXSCAN" in json.dumps(plan), f"{coll.name}: {plan}"
+        assert "COLLSCAN" not in json.dumps(plan), f"{coll.name}: {plan}"
+
+
+def test_pick_date_query_range_is_half_open(appmod):
+    query = appmod.pick_date_query("2025-01-02", "2025-01-03")
+    assert query == {"MIC需求起日": {"$gte": dt.datetime(2025, 1, 2), "$lt": dt.datetime(2025, 1, 4)}}
+    for coll in appmod.PICK_COLLECTIONS:
+        assert coll.count_documents(query) == 2
@@ -0,0 +1,35 @@
+"""
+出貨單產生：料號 / 版本 為數值（舊資料未經 schema 轉換）時也要能輸出。不需要 mongod。
+
+    python -m pytest tests
+"""
+import datetime as dt
+import io
+import os
+import sys
+
+import pytest
+from openpyxl import load_workbook
+
+
+@pytest.fixture(scope="module")
+def appmod():
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+    import app as appmod
+
+    return appmod
+
+
+def _slip_rows(resp):
+    try:
+        data = b"".join(resp.response)
+    finally:
+        resp.close()
+    return list(load_workbook(io.BytesIO(data)).worksheets[0].iter_rows(values_only=True))
+
+
+@pytest.mark.parametrize("version, expected", [(1, "251140 1"), (0, "251140 0"), ("B", "251140 B"), (None, "251140")])
+def test_slip_product_with_version(appmod, version, expected):
+    groups = {"PO1": [{"料號": 251140, "版本": version, "產品中文名稱": None, "數量": 2, "單價": 10}]}
+    rows = _slip_rows(appmod.stream_slips_workbook(groups, dt.date(2025, 8, 1)))
+    assert any(row and "01" in row and expected in row for row in rows), rows